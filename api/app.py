@@ -1,20 +1,29 @@
 from fastapi import FastAPI, Request, Response
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, MessageHandler, filters, ContextTypes
 import os
 import logging
+import logging.handlers
 import asyncio
 import redis.asyncio as redis
 import json
 from urllib.parse import urlparse
-from xai_sdk import Client
-from xai_sdk.chat import user, system, assistant
-from xai_sdk.search import SearchParameters
 import re
-import aiohttp  # For downloading the image file
-from openai import AsyncOpenAI  # For OpenAI async client
 import base64  # For encoding/decoding image data
 import io
+import time
+import uuid
+import zlib
+import hashlib
+import random
+import atexit
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from queue import Empty, SimpleQueue
+# xai_sdk, openai, aiohttp and Pillow are imported on first use to keep cold starts fast
 
 app = FastAPI()
 
@@ -24,696 +33,3034 @@ GROK_API_KEY = os.getenv("GROK_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GROK_MODEL = os.getenv("GROK_MODEL", "grok-3-mini-fast")
 REDIS_URL = os.getenv("REDIS_URL")
+# Where history, caches and dedupe keys live: "redis", "memory" (in-process LRU), "sqlite" (on-disk, WAL),
+# or "auto" for Redis when REDIS_URL is set and memory otherwise
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "auto").lower()
+STORAGE_MEMORY_MAX_KEYS = int(os.getenv("STORAGE_MEMORY_MAX_KEYS", "10000"))
+STORAGE_SQLITE_PATH = os.getenv("STORAGE_SQLITE_PATH", "bahlulbot.db")
+# With "auto", seconds to use in-process storage after Redis could not be reached before trying Redis again
+STORAGE_FALLBACK_RETRY_INTERVAL = float(os.getenv("STORAGE_FALLBACK_RETRY_INTERVAL", "30"))
 WHITELIST_IDS = os.getenv("WHITELIST_IDS", "").split(",") if os.getenv("WHITELIST_IDS") else []
+# Bot API server to use instead of api.telegram.org, e.g. a local Bot API server or the benchmark's stand-in
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").rstrip("/")
+# "warm" keeps one Application for the process lifetime, "per_request" rebuilds it for every update
+BOT_LIFECYCLE = os.getenv("BOT_LIFECYCLE", "warm")
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+# Outbound Telegram rate limits: messages per second overall and per chat, and per minute in groups
+TELEGRAM_RATE_LIMIT = os.getenv("TELEGRAM_RATE_LIMIT", "true").lower() == "true"
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "30"))
+RATE_LIMIT_CHAT_PER_SECOND = float(os.getenv("RATE_LIMIT_CHAT_PER_SECOND", "1"))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "50"))
+# Approximate token budget for the history sent with each Grok prompt
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+# Fold older turns into a cached summary once a conversation has more than HISTORY_SUMMARY_THRESHOLD messages
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "false").lower() == "true"
+HISTORY_SUMMARY_THRESHOLD = int(os.getenv("HISTORY_SUMMARY_THRESHOLD", "20"))
+HISTORY_SUMMARY_KEEP = int(os.getenv("HISTORY_SUMMARY_KEEP", "8"))
+# Opt-in cache for /ask answers. ASK_CACHE_CONTEXT decides how history affects it:
+# "auto" ignores history unless the question refers back to it, "hash" keys on the history, "bypass" skips the cache when there is history
+ASK_CACHE = os.getenv("ASK_CACHE", "false").lower() == "true"
+ASK_CACHE_CONTEXT = os.getenv("ASK_CACHE_CONTEXT", "auto")
+ASK_CACHE_TTL = int(os.getenv("ASK_CACHE_TTL", "3600"))
+ASK_CACHE_SIZE = int(os.getenv("ASK_CACHE_SIZE", "256"))
+# Opt-in cache of generated images, answered by resending the Telegram file_id of the first upload
+IMAGE_CACHE = os.getenv("IMAGE_CACHE", "false").lower() == "true"
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+# Largest photo accepted for /edit, and the size photos are downscaled to before upload (needs Pillow, 0 disables)
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))
+MEDIA_MAX_DIMENSION = int(os.getenv("MEDIA_MAX_DIMENSION", "1024"))
+# Long-polling mode (python api/app.py): updates processed at once, and getUpdates long-poll timeout in seconds
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "16"))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+POLL_MAX_ATTEMPTS = int(os.getenv("POLL_MAX_ATTEMPTS", "3"))
+# Seconds between getUpdates calls while every update Telegram returns is still being processed
+POLL_BUSY_INTERVAL = float(os.getenv("POLL_BUSY_INTERVAL", "1"))
+HISTORY_TTL = int(os.getenv("HISTORY_TTL", "3600"))
+# "compact" stores history entries as versioned compact JSON, zlib-compressed from HISTORY_COMPRESS_MIN_BYTES;
+# "json" keeps writing plain JSON entries that older deployments can read. Both read either format.
+HISTORY_ENCODING = os.getenv("HISTORY_ENCODING", "compact")
+HISTORY_COMPRESS_MIN_BYTES = int(os.getenv("HISTORY_COMPRESS_MIN_BYTES", "512"))
+# Concurrency limit and per-call timeouts (seconds) for Grok requests
+GROK_MAX_CONCURRENCY = int(os.getenv("GROK_MAX_CONCURRENCY", "16"))
+GROK_CHAT_TIMEOUT = float(os.getenv("GROK_CHAT_TIMEOUT", "120"))
+GROK_IMAGE_TIMEOUT = float(os.getenv("GROK_IMAGE_TIMEOUT", "120"))
+# Live search policy: "smart" picks off/auto/on per message, or force "off", "auto" or "on";
+# SEARCH_CHAT_POLICIES overrides it per chat, e.g. "-100123:off,456:on"
+SEARCH_POLICIES = ("smart", "off", "auto", "on")
+SEARCH_POLICY = os.getenv("SEARCH_POLICY", "smart").strip()
+SEARCH_CHAT_POLICIES = {
+    chat_id.strip(): policy.strip()
+    for chat_id, policy in (item.split(":", 1) for item in os.getenv("SEARCH_CHAT_POLICIES", "").split(",") if ":" in item)
+}
+for policy in [SEARCH_POLICY, *SEARCH_CHAT_POLICIES.values()]:
+    if policy not in SEARCH_POLICIES:
+        raise ValueError(f"Unknown search policy {policy!r}; expected one of {', '.join(SEARCH_POLICIES)}")
+# Text providers in order of preference ("grok", "openai", "fake"); later ones are used for failover and hedging
+LLM_PROVIDERS = [name.strip() for name in os.getenv("LLM_PROVIDERS", "grok").split(",") if name.strip()]
+OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
+OPENAI_CHAT_TIMEOUT = float(os.getenv("OPENAI_CHAT_TIMEOUT", "120"))
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.05"))
+# Hedging sends a backup request to the second provider once the first is slower than its p95 latency
+LLM_HEDGE = os.getenv("LLM_HEDGE", "false").lower() == "true"
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "8"))
+# A provider is skipped for BREAKER_COOLDOWN seconds after BREAKER_FAILURE_THRESHOLD consecutive failures
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+# Stream Grok replies into a placeholder message that is edited as tokens arrive
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_EDIT_MIN_CHARS = int(os.getenv("STREAM_EDIT_MIN_CHARS", "40"))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+# Pause between the parts of a split reply, and attempts per part when Telegram rate limits us
+REPLY_CHUNK_INTERVAL = float(os.getenv("REPLY_CHUNK_INTERVAL", "1.0"))
+REPLY_MAX_ATTEMPTS = int(os.getenv("REPLY_MAX_ATTEMPTS", "5"))
+# "off" processes updates inside the webhook request, "local" or "redis" acks immediately and queues them for workers
+UPDATE_QUEUE_MODE = os.getenv("UPDATE_QUEUE_MODE", "off")
+QUEUE_PARTITIONS = int(os.getenv("QUEUE_PARTITIONS", "4"))
+QUEUE_RUN_WORKERS = os.getenv("QUEUE_RUN_WORKERS", "true").lower() == "true"
+QUEUE_VISIBILITY_TIMEOUT = int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", "300"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+# Seconds a worker owns a Redis queue partition without renewing; leases are renewed every third of it while working
+QUEUE_OWNER_TTL = float(os.getenv("QUEUE_OWNER_TTL", "30"))
+# Remember processed update_ids so Telegram retries are dropped
+DEDUPE_TTL = int(os.getenv("DEDUPE_TTL", "900"))
+DEDUPE_INFLIGHT_TTL = int(os.getenv("DEDUPE_INFLIGHT_TTL", "300"))
+DEDUPE_LRU_SIZE = int(os.getenv("DEDUPE_LRU_SIZE", "2048"))
+# Concurrent image jobs allowed globally, per chat and per user (0 means unlimited)
+IMAGE_GLOBAL_LIMIT = int(os.getenv("IMAGE_GLOBAL_LIMIT", "4"))
+IMAGE_CHAT_LIMIT = int(os.getenv("IMAGE_CHAT_LIMIT", "2"))
+IMAGE_USER_LIMIT = int(os.getenv("IMAGE_USER_LIMIT", "1"))
+# Seconds a slot is held before it expires, and how long a request may wait in the queue
+IMAGE_SLOT_TTL = int(os.getenv("IMAGE_SLOT_TTL", "300"))
+IMAGE_QUEUE_TIMEOUT = int(os.getenv("IMAGE_QUEUE_TIMEOUT", "300"))
+# Logging: root level, per-subsystem levels (e.g. "redis=WARNING,llm=DEBUG,httpx=WARNING"), "text" or "json" lines,
+# and whether records are written from a background thread
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE = os.getenv("LOG_QUEUE", "true").lower() == "true"
+LOG_SUBSYSTEMS = ("telegram", "llm", "redis", "storage", "queue")
+# Fraction of requests whose user content (updates, prompts, replies) is logged, and the characters kept of each
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "200"))
+# Write spans of each update's stages as JSON lines to TRACE_FILE and/or POST them to an OTLP/HTTP collector
+# (e.g. http://localhost:4318/v1/traces); TRACE_SAMPLE_RATE is the fraction of updates traced
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+# Event loop monitor: check interval and lag reported as a stall (seconds);
+# LOOP_SLOW_CALLBACK > 0 turns on asyncio debug mode to log callbacks slower than that
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "false").lower() == "true"
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.25"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.1"))
+LOOP_SLOW_CALLBACK = float(os.getenv("LOOP_SLOW_CALLBACK", "0"))
+# Bearer token required to read /metrics (unset leaves it open)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Upper bounds (seconds) of the latency histogram buckets
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Request-scoped logging context: update_id, chat_id and whether this request's payloads are sampled
+log_context = ContextVar("log_context", default=None)
+
+# Copy the correlation ids of the current request onto each log record
+class CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        context = log_context.get() or {}
+        record.update_id = context.get("update_id", "-")
+        record.chat_id = context.get("chat_id", "-")
+        return True
+
+# One JSON object per log line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "update_id": getattr(record, "update_id", "-"),
+            "chat_id": getattr(record, "chat_id", "-"),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Configure logging: records are handed to a background thread through a queue so the event loop never blocks on I/O
+def configure_logging():
+    # Per-subsystem levels; other names are taken as logger names, e.g. httpx=WARNING.
+    # Applied even when the runtime installed its own handler, since httpx=WARNING keeps the bot token out of the logs.
+    for item in LOG_LEVELS.split(","):
+        if "=" not in item:
+            continue
+        name, level = (part.strip() for part in item.split("=", 1))
+        logger_name = f"{__name__}.{name}" if name in LOG_SUBSYSTEMS else name
+        logging.getLogger(logger_name).setLevel(level.upper())
+    
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    root.setLevel(LOG_LEVEL)
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [update %(update_id)s, chat %(chat_id)s] %(message)s')
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    if LOG_QUEUE:
+        log_queue = SimpleQueue()
+        handler = logging.handlers.QueueHandler(log_queue)
+        listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        handler = stream_handler
+    handler.addFilter(CorrelationFilter())
+    root.addHandler(handler)
+
+configure_logging()
 logger = logging.getLogger(__name__)
+telegram_logger = logging.getLogger(f"{__name__}.telegram")
+llm_logger = logging.getLogger(f"{__name__}.llm")
+redis_logger = logging.getLogger(f"{__name__}.redis")
+storage_logger = logging.getLogger(f"{__name__}.storage")
+queue_logger = logging.getLogger(f"{__name__}.queue")
+
+# Set the correlation ids for log records of the current task and the tasks it starts
+@contextmanager
+def log_scope(update_id, chat_id=None):
+    current = log_context.get()
+    if current is not None and current["update_id"] == update_id:
+        # Nested scope for the same update (webhook, then dedupe): keep its sampling decision
+        sampled = current["sampled"]
+    else:
+        sampled = LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+    token = log_context.set({"update_id": update_id, "chat_id": chat_id if chat_id is not None else "-", "sampled": sampled})
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+# A payload that is serialized and truncated only if the log record is emitted
+class LogPayload:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        text = self.payload if isinstance(self.payload, str) else json.dumps(self.payload, ensure_ascii=False, default=str)
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            return f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} chars)"
+        return text
+
+# Log user content (updates, prompts, replies) only for sampled requests, truncated to LOG_PAYLOAD_MAX_CHARS
+def log_payload(log, label: str, payload):
+    context = log_context.get()
+    if context is None:
+        sampled = LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+    else:
+        sampled = context["sampled"]
+    if sampled and payload is not None:
+        log.info("%s: %s", label, LogPayload(payload))
 
 telegram_app = None
+telegram_app_loop = None
+telegram_app_lock = None
+telegram_app_lock_loop = None
+# Priority of Telegram requests made in the current task: "interactive" or "bulk"
+send_priority = ContextVar("send_priority", default="interactive")
+redis_client_shared = None
+redis_client_loop = None
+store_shared = None
+xai_client_shared = None
+xai_client_loop = None
+grok_semaphore = None
+provider_stats = {}
+search_mode_stats = {}
+openai_client_shared = None
+openai_client_loop = None
+pil_image_module = None
+orjson_module = None
+http_session = None
+http_session_loop = None
+update_queue = None
+update_worker_tasks = []
+update_workers_running = False
+seen_update_ids = OrderedDict()
+# Exceptions that escaped a handler, by update_id, until process_update_once re-raises them
+handler_errors = {}
+local_slots = {}
+local_slot_waiters = {}
+background_tasks = set()
+ask_cache = OrderedDict()
+ask_cache_inflight = {}
+loop_monitor_task = None
+
+# Metrics in the Prometheus text format, served by /metrics (per process)
+metrics_registry = []
+
+# Format a label set for the Prometheus text format, escaping the values
+def format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# Monotonic counter with one value per label set
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        metrics_registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+# Histogram of durations in seconds with one set of buckets per label set
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        metrics_registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["buckets"][index] += 1
+                break
+        series["sum"] += value
+        series["count"] += 1
+
+    # Time the block and observe its duration, also when it raises
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series['count']}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+webhook_seconds = Histogram("bahlul_webhook_seconds", "Time spent handling a webhook request", ("mode",))
+telegram_init_seconds = Histogram("bahlul_telegram_init_seconds", "Time spent building and initializing the Telegram application")
+store_seconds = Histogram("bahlul_store_seconds", "Duration of storage backend operations", ("operation",))
+provider_seconds = Histogram("bahlul_provider_seconds", "Duration of Grok and OpenAI calls", ("provider", "kind"))
+upload_seconds = Histogram("bahlul_upload_seconds", "Time spent sending a photo to Telegram", ("kind",))
+queue_wait_seconds = Histogram("bahlul_queue_wait_seconds", "Time spent waiting in the update queue or for an image slot", ("queue",))
+handler_seconds = Histogram("bahlul_handler_seconds", "Time spent in a handler", ("handler",))
+updates_total = Counter("bahlul_updates_total", "Updates processed, by handler", ("handler",))
+errors_total = Counter("bahlul_errors_total", "Errors, by handler or subsystem", ("handler",))
+slot_contention_total = Counter("bahlul_slot_contention_total", "Requests that had to queue for a concurrency slot", ("kind",))
+loop_lag_seconds = Histogram("bahlul_loop_lag_seconds", "How late the event loop monitor woke up")
+loop_stalls_total = Counter("bahlul_loop_stalls_total", "Event loop stalls longer than LOOP_STALL_THRESHOLD")
+cache_lookups_total = Counter("bahlul_cache_lookups_total", "Cache lookups, by cache and result", ("cache", "result"))
+
+# Render the provider and live search statistics kept for routing and logging
+def render_provider_metrics() -> list:
+    lines = [
+        "# HELP bahlul_provider_circuit_open Whether the circuit breaker of an LLM provider is open",
+        "# TYPE bahlul_provider_circuit_open gauge",
+    ]
+    for name, stats in sorted(provider_stats.items()):
+        lines.append(f"bahlul_provider_circuit_open{format_labels(('provider',), (name,))} {0 if stats.available() else 1}")
+    lines += [
+        "# HELP bahlul_provider_p95_seconds Recent p95 latency of an LLM provider",
+        "# TYPE bahlul_provider_p95_seconds gauge",
+    ]
+    for name, stats in sorted(provider_stats.items()):
+        p95 = stats.p95()
+        if p95 is not None:
+            lines.append(f"bahlul_provider_p95_seconds{format_labels(('provider',), (name,))} {p95}")
+    for field, documentation in (("requests", "Grok calls"), ("searched", "Grok calls that used live search"), ("sources", "Live search sources used")):
+        lines += [f"# HELP bahlul_search_{field}_total {documentation}, by search mode", f"# TYPE bahlul_search_{field}_total counter"]
+        for mode, stats in sorted(search_mode_stats.items()):
+            lines.append(f"bahlul_search_{field}_total{format_labels(('mode',), (mode,))} {stats[field]}")
+    return lines
+
+# Render all metrics in the Prometheus text exposition format
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines += metric.render()
+    lines += render_provider_metrics()
+    return "\n".join(lines) + "\n"
+
+# Tracing: OpenTelemetry-style spans around the stages of an update
+current_span = ContextVar("current_span", default=None)
+# Marks a trace that was not sampled, so its stages don't start traces of their own
+UNSAMPLED_SPAN = object()
+open_spans = set()
+trace_queue = None
+trace_exporter_thread = None
+
+# One timed stage of an update
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.events = []
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def add_event(self, name: str, **attributes):
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "events": self.events,
+            "error": self.error,
+        }
+
+# Record a span around the block; a no-op unless TRACE_FILE or TRACE_OTLP_ENDPOINT is set
+@contextmanager
+def trace_span(name: str, **attributes):
+    parent = current_span.get()
+    if not (TRACE_FILE or TRACE_OTLP_ENDPOINT) or parent is UNSAMPLED_SPAN:
+        yield None
+        return
+    if parent is None and random.random() >= TRACE_SAMPLE_RATE:
+        token = current_span.set(UNSAMPLED_SPAN)
+        try:
+            yield None
+        finally:
+            current_span.reset(token)
+        return
+    
+    if parent is None:
+        span = Span(name, uuid.uuid4().hex, None, attributes)
+    else:
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+    token = current_span.set(span)
+    open_spans.add(span)
+    try:
+        yield span
+    except Exception as e:
+        span.error = str(e)
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        open_spans.discard(span)
+        current_span.reset(token)
+        export_span(span)
+
+# Hand a finished span to the exporter thread, starting it on first use
+def export_span(span: Span):
+    global trace_queue, trace_exporter_thread
+    if trace_queue is None:
+        trace_queue = SimpleQueue()
+        trace_exporter_thread = threading.Thread(target=run_trace_exporter, name="trace-exporter", daemon=True)
+        trace_exporter_thread.start()
+        atexit.register(stop_trace_exporter)
+    trace_queue.put(span.to_dict())
+
+# Flush the spans still queued when the process exits
+def stop_trace_exporter():
+    trace_queue.put(None)
+    trace_exporter_thread.join(timeout=5)
+
+# Convert an attribute value to OTLP JSON
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+# Convert spans to an OTLP/HTTP JSON export request
+def build_otlp_request(spans: list) -> dict:
+    otlp_spans = []
+    for span in spans:
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["end_ns"]),
+            "attributes": otlp_attributes(span["attributes"]),
+            "events": [
+                {"timeUnixNano": str(event["time_ns"]), "name": event["name"], "attributes": otlp_attributes(event["attributes"])}
+                for event in span["events"]
+            ],
+            "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        otlp_spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": otlp_attributes({"service.name": "bahlulbot"})},
+        "scopeSpans": [{"scope": {"name": "bahlulbot"}, "spans": otlp_spans}],
+    }]}
+
+# Exporter thread: batch finished spans and write them to TRACE_FILE and/or TRACE_OTLP_ENDPOINT
+def run_trace_exporter():
+    import urllib.request
+    
+    running = True
+    while running:
+        batch = [trace_queue.get()]
+        deadline = time.monotonic() + 1
+        while len(batch) < 512 and time.monotonic() < deadline:
+            try:
+                batch.append(trace_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except Empty:
+                break
+        if None in batch:
+            running = False
+            batch = [span for span in batch if span is not None]
+        if not batch:
+            continue
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, "a") as f:
+                    f.writelines(json.dumps(span, default=str) + "\n" for span in batch)
+            if TRACE_OTLP_ENDPOINT:
+                body = json.dumps(build_otlp_request(batch), default=str).encode()
+                request = urllib.request.Request(TRACE_OTLP_ENDPOINT, data=body, headers={"Content-Type": "application/json"})
+                urllib.request.urlopen(request, timeout=5).close()
+        except Exception as e:
+            logger.warning(f"Could not export {len(batch)} spans: {str(e)}")
+
+# Event loop monitor: sleep for LOOP_MONITOR_INTERVAL and treat oversleeping as lag.
+# A stall is logged with the spans that were open, and recorded as an event on each of them.
+async def monitor_event_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+        lag = max(loop.time() - started_at - LOOP_MONITOR_INTERVAL, 0.0)
+        loop_lag_seconds.observe(lag)
+        if lag >= LOOP_STALL_THRESHOLD:
+            loop_stalls_total.inc()
+            spans = list(open_spans)
+            for span in spans:
+                span.add_event("loop.stall", lag_ms=round(lag * 1000, 1))
+            # Report the innermost open stages, which are the ones that were running or awaiting
+            parent_ids = {span.parent_id for span in spans}
+            stages = {}
+            for span in spans:
+                if span.span_id not in parent_ids:
+                    stages[span.name] = stages.get(span.name, 0) + 1
+            summary = ", ".join(f"{name} x{count}" for name, count in sorted(stages.items())) or "none"
+            logger.warning(f"Event loop stalled for {lag * 1000:.0f} ms; open stages: {summary}")
+
+# Start the event loop monitor, and asyncio's slow callback logging when LOOP_SLOW_CALLBACK is set
+def start_loop_monitor():
+    global loop_monitor_task
+    loop = asyncio.get_running_loop()
+    if LOOP_SLOW_CALLBACK > 0:
+        # Debug mode makes asyncio log every callback that runs longer than this, naming the coroutine
+        loop.set_debug(True)
+        loop.slow_callback_duration = LOOP_SLOW_CALLBACK
+    if LOOP_MONITOR and (loop_monitor_task is None or loop_monitor_task.done()):
+        loop_monitor_task = loop.create_task(monitor_event_loop())
+
+# Stop the event loop monitor
+async def stop_loop_monitor():
+    global loop_monitor_task
+    if loop_monitor_task is not None:
+        loop_monitor_task.cancel()
+        await asyncio.gather(loop_monitor_task, return_exceptions=True)
+        loop_monitor_task = None
 
 # Function to check if chat_id or user_id is in whitelist
 def is_whitelisted(chat_id: int, user_id: int) -> bool:
     whitelisted = str(chat_id) in WHITELIST_IDS or str(user_id) in WHITELIST_IDS
-    logger.info(f"Checking whitelist: chat_id={chat_id}, user_id={user_id}, whitelisted={whitelisted}")
+    logger.debug(f"Checking whitelist: chat_id={chat_id}, user_id={user_id}, whitelisted={whitelisted}")
     return whitelisted
 
-# Command handler for /start
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Received /start command")
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    await update.message.reply_text("Hello! I'm BahlulBot, powered by Grok. Use /ask <your question> to get a response, or send a message in private chat.")
-    logger.info("Sent /start response")
+# Get the shared async xAI client and its concurrency limiter for the running loop
+def get_xai_client():
+    global xai_client_shared, xai_client_loop, grok_semaphore
+    loop = asyncio.get_running_loop()
+    if xai_client_shared is None or xai_client_loop is not loop:
+        from xai_sdk import AsyncClient
+        xai_client_shared = AsyncClient(api_key=GROK_API_KEY, timeout=max(GROK_CHAT_TIMEOUT, GROK_IMAGE_TIMEOUT))
+        grok_semaphore = asyncio.Semaphore(GROK_MAX_CONCURRENCY)
+        xai_client_loop = loop
+        llm_logger.info("Created shared xAI async client")
+    return xai_client_shared
 
-# Command handler for /ask
-async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message is None:
-        logger.info("Received /ask command with no message content")
-        return
-    
-    chat_type = update.message.chat.type
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    message_thread_id = update.message.message_thread_id
-    query = ' '.join(context.args) if context.args else None
-    
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
-    logger.info(f"Received /ask command from chat type {chat_type}, chat ID: {chat_id}, thread ID: {message_thread_id}, query: {query}")
+# Create a Grok chat session populated with the conversation
+def build_grok_chat(xai_client, conversation: list, search_mode: str = "auto"):
+    from xai_sdk.chat import user, system, assistant
+    from xai_sdk.search import SearchParameters
+    chat = xai_client.chat.create(
+        model=GROK_MODEL,
+        search_parameters=SearchParameters(mode=search_mode)
+    )
+    for msg in conversation:
+        if msg["role"] == "user":
+            chat.append(user(msg["content"]))
+        elif msg["role"] == "system":
+            chat.append(system(msg["content"][0]["text"]))
+        elif msg["role"] == "assistant":
+            chat.append(assistant(msg["content"]))
+    return chat
+
+# Messages that need fresh information from the web
+URL_PATTERN = re.compile(r"https?://|www\.", re.IGNORECASE)
+RECENCY_PATTERN = re.compile(
+    r"\b(today|tonight|yesterday|tomorrow|now|currently|latest|recent|news|breaking|this (week|month|year)|"
+    r"price|stock|weather|score|election|20\d\d|hari ini|kemarin|besok|sekarang|terbaru|berita|harga|cuaca)\b",
+    re.IGNORECASE,
+)
+# Messages that look like factual questions, where the model may decide to search
+QUESTION_PATTERN = re.compile(
+    r"\?\s*$|^\s*(who|what|when|where|which|how|why|is|are|does|did|can|siapa|apa|kapan|dimana|di mana|berapa|bagaimana|kenapa|mengapa)\b",
+    re.IGNORECASE,
+)
+
+# Pick the Grok live search mode for a message: "on" for URLs and recency, "auto" for questions, "off" for chit-chat
+def select_search_mode(text: str, chat_id: int, is_command: bool = False) -> str:
+    policy = SEARCH_CHAT_POLICIES.get(str(chat_id), SEARCH_POLICY)
+    if policy in ("off", "auto", "on"):
+        return policy
+    if URL_PATTERN.search(text) or RECENCY_PATTERN.search(text):
+        return "on"
+    # /ask is an explicit question, so let the model decide instead of disabling search
+    if is_command or QUESTION_PATTERN.search(text):
+        return "auto"
+    return "off"
+
+# Record latency and live search sources used for a Grok call
+def record_search_usage(search_mode: str, latency: float, sources_used: int):
+    stats = search_mode_stats.setdefault(search_mode, {"requests": 0, "searched": 0, "sources": 0, "latency": 0.0})
+    stats["requests"] += 1
+    stats["latency"] += latency
+    stats["sources"] += sources_used
+    if sources_used:
+        stats["searched"] += 1
+    llm_logger.info(f"Grok search mode {search_mode}: {latency:.2f}s, {sources_used} sources "
+                f"(mode average {stats['latency'] / stats['requests']:.2f}s, searched {stats['searched']}/{stats['requests']})")
+
+# Call Grok chat with the conversation without blocking the event loop
+async def grok_chat(conversation: list, search_mode: str = "auto") -> str:
+    xai_client = get_xai_client()
+    chat = build_grok_chat(xai_client, conversation, search_mode)
+    async with grok_semaphore:
+        started_at = time.monotonic()
+        response = await asyncio.wait_for(chat.sample(), timeout=GROK_CHAT_TIMEOUT)
+    record_search_usage(search_mode, time.monotonic() - started_at, response.usage.num_sources_used)
+    return response.content
+
+# Generate an image with Grok without blocking the event loop
+async def grok_image(prompt: str):
+    xai_client = get_xai_client()
+    async with grok_semaphore:
+        with provider_seconds.time(provider="grok", kind="image"), trace_span("provider.image", provider="grok"):
+            return await asyncio.wait_for(
+                xai_client.image.sample(
+                    model="grok-2-image",
+                    prompt=prompt,
+                    image_format="url"
+                ),
+                timeout=GROK_IMAGE_TIMEOUT
+            )
+
+# Call OpenAI chat completions with the conversation (no live search)
+async def openai_chat(conversation: list, search_mode: str = "auto") -> str:
+    messages = []
+    for msg in conversation:
+        content = msg["content"][0]["text"] if msg["role"] == "system" else msg["content"]
+        messages.append({"role": msg["role"], "content": content})
+    response = await asyncio.wait_for(
+        get_openai_client().chat.completions.create(model=OPENAI_CHAT_MODEL, messages=messages),
+        timeout=OPENAI_CHAT_TIMEOUT
+    )
+    return response.choices[0].message.content
+
+# In-process provider for tests and benchmarks: echoes the last user message after FAKE_LLM_LATENCY seconds
+async def fake_chat(conversation: list, search_mode: str = "auto") -> str:
+    await asyncio.sleep(FAKE_LLM_LATENCY)
+    last_user = next((msg["content"] for msg in reversed(conversation) if msg["role"] == "user"), "")
+    return f"Echo: {last_user}"
+
+LLM_PROVIDER_FUNCTIONS = {
+    "grok": grok_chat,
+    "openai": openai_chat,
+    "fake": fake_chat,
+}
+
+# Recent latencies and circuit breaker state of one LLM provider
+class ProviderStats:
+    def __init__(self):
+        self.latencies = deque(maxlen=100)
+        self.failures = 0
+        self.opened_at = 0
+
+    def available(self) -> bool:
+        # Open after too many consecutive failures; after the cooldown, let requests probe it again
+        if self.failures < BREAKER_FAILURE_THRESHOLD:
+            return True
+        return time.monotonic() - self.opened_at >= BREAKER_COOLDOWN
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+    def p95(self):
+        if len(self.latencies) < 5:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+# Call one provider, recording its latency and outcome
+async def call_provider(name: str, conversation: list, search_mode: str) -> str:
+    stats = provider_stats.setdefault(name, ProviderStats())
+    started_at = time.monotonic()
+    try:
+        with provider_seconds.time(provider=name, kind="chat"), trace_span("provider.chat", provider=name):
+            response = await LLM_PROVIDER_FUNCTIONS[name](conversation, search_mode)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        stats.record_failure()
+        if stats.failures == BREAKER_FAILURE_THRESHOLD:
+            llm_logger.warning(f"Circuit breaker opened for LLM provider {name}")
+        raise
+    stats.record_success(time.monotonic() - started_at)
+    return response
+
+# Call the primary provider, and the backup too if the primary is slower than its p95 or fails; first answer wins
+async def hedged_call(primary: str, backup: str, conversation: list, search_mode: str) -> str:
+    p95 = provider_stats.setdefault(primary, ProviderStats()).p95()
+    hedge_delay = max(p95, LLM_HEDGE_MIN_DELAY) if p95 is not None else LLM_HEDGE_DEFAULT_DELAY
+    primary_task = asyncio.create_task(call_provider(primary, conversation, search_mode))
+    tasks = {primary_task}
+    try:
+        done, tasks = await asyncio.wait(tasks, timeout=hedge_delay)
+        if primary_task in done and primary_task.exception() is None:
+            return primary_task.result()
+        
+        llm_logger.info(f"Hedging LLM request to {backup} after {hedge_delay:.1f}s")
+        error = primary_task.exception() if primary_task in done else None
+        tasks.add(asyncio.create_task(call_provider(backup, conversation, search_mode)))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Streaming goes straight to Grok, so only stream while Grok is the preferred available provider
+def can_stream_replies() -> bool:
+    if not STREAM_REPLIES:
+        return False
+    providers = [name for name in LLM_PROVIDERS if provider_stats.setdefault(name, ProviderStats()).available()]
+    return bool(providers) and providers[0] == "grok"
+
+# Generate a text reply through the configured providers, skipping those whose circuit breaker is open
+async def generate_reply(conversation: list, search_mode: str = "auto") -> str:
+    providers = [name for name in LLM_PROVIDERS if provider_stats.setdefault(name, ProviderStats()).available()]
+    if not providers:
+        # Every breaker is open; probe the preferred provider rather than failing outright
+        providers = LLM_PROVIDERS[:1]
     
-    if not query:
-        reply_params = {"text": "Please provide a question after /ask (e.g., /ask What is the capital of France?)"}
+    errors = []
+    if LLM_HEDGE and len(providers) > 1:
+        try:
+            return await hedged_call(providers[0], providers[1], conversation, search_mode)
+        except Exception as e:
+            errors.append(f"{providers[0]}/{providers[1]}: {str(e)}")
+            providers = providers[2:]
+    for name in providers:
+        try:
+            return await call_provider(name, conversation, search_mode)
+        except Exception as e:
+            llm_logger.error(f"LLM provider {name} failed: {str(e)}")
+            errors.append(f"{name}: {str(e)}")
+    raise Exception(f"All LLM providers failed ({'; '.join(errors)})")
+
+# Stream a Grok chat completion, yielding the accumulated text after each chunk
+async def grok_chat_stream(conversation: list, search_mode: str = "auto"):
+    xai_client = get_xai_client()
+    chat = build_grok_chat(xai_client, conversation, search_mode)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GROK_CHAT_TIMEOUT
+    stats = provider_stats.setdefault("grok", ProviderStats())
+    async with grok_semaphore:
+        started_at = time.monotonic()
+        stream = chat.stream()
+        response = None
+        try:
+            while True:
+                try:
+                    response, chunk = await asyncio.wait_for(stream.__anext__(), timeout=max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    break
+                yield response.content
+        except Exception:
+            # Count stream failures against Grok's breaker, so can_stream_replies() stops choosing a failing Grok
+            stats.record_failure()
+            if stats.failures == BREAKER_FAILURE_THRESHOLD:
+                llm_logger.warning("Circuit breaker opened for LLM provider grok")
+            raise
+        finally:
+            await stream.aclose()
+    stats.record_success(time.monotonic() - started_at)
+    provider_seconds.observe(time.monotonic() - started_at, provider="grok", kind="stream")
+    if response is not None:
+        record_search_usage(search_mode, time.monotonic() - started_at, response.usage.num_sources_used)
+
+# Split text into blocks: code fences are kept whole, everything else is split on blank lines
+def split_into_blocks(text: str) -> list:
+    blocks = []
+    current = []
+    in_code = False
+    for line in text.split("\n"):
+        if line.lstrip().startswith("```"):
+            if not in_code and current:
+                blocks.append("\n".join(current))
+                current = []
+            current.append(line)
+            in_code = not in_code
+            if not in_code:
+                blocks.append("\n".join(current))
+                current = []
+        elif not in_code and not line.strip():
+            if current:
+                blocks.append("\n".join(current))
+                current = []
+        else:
+            current.append(line)
+    if current:
+        blocks.append("\n".join(current))
+    return blocks
+
+# Matches an opening code fence: the ``` marker with an optional language tag, then anything else on the line
+CODE_FENCE_PATTERN = re.compile(r'^\s*(```(?:[\w+#.-]{1,32}(?=\s|$))?)(.*)$')
+
+# Split a block that is longer than limit on line boundaries, re-opening code fences in each part
+def split_long_block(block: str, limit: int) -> list:
+    lines = block.split("\n")
+    match = CODE_FENCE_PATTERN.match(lines[0])
+    fence = match.group(1) if match else None
+    # Only the marker and language tag are repeated; a fence that would leave little room is treated as plain text
+    if fence and limit - len(fence) - len("\n\n```") > limit // 2:
+        lines = lines[1:-1] if len(lines) > 1 and lines[-1].strip() == "```" else lines[1:]
+        if match.group(2).strip():
+            # Text after the marker on the opening line is content, not part of the fence
+            lines.insert(0, match.group(2))
+        limit -= len(fence) + len("\n\n```")
+    else:
+        fence = None
+    parts = []
+    current = ""
+    for line in lines:
+        # Hard-wrap lines that do not fit on their own
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    if fence:
+        parts = [f"{fence}\n{part}\n```" for part in parts]
+    return parts
+
+# Split a reply into messages that fit Telegram's limit, preferring paragraph and code-block boundaries
+def split_message(text: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> list:
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = ""
+    for block in split_into_blocks(text):
+        pieces = split_long_block(block, limit) if len(block) > limit else [block]
+        for piece in pieces:
+            candidate = f"{current}\n\n{piece}" if current else piece
+            if len(candidate) > limit:
+                chunks.append(current)
+                current = piece
+            else:
+                current = candidate
+    if current:
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk]
+
+# Seconds to wait after a RetryAfter (python-telegram-bot may report an int or a timedelta)
+def get_retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+# Call a Telegram method, retrying transient network errors with backoff and waiting out rate limits
+# (left to the rate limiter when it is enabled, since it already retries them)
+async def send_with_retry(send, *args, **kwargs):
+    delay = 1
+    for attempt in range(1, REPLY_MAX_ATTEMPTS + 1):
+        try:
+            return await send(*args, **kwargs)
+        except BadRequest:
+            # A subclass of NetworkError in PTB, but permanent: the same request would fail again
+            raise
+        except RetryAfter as e:
+            if TELEGRAM_RATE_LIMIT or attempt == REPLY_MAX_ATTEMPTS:
+                raise
+            retry_after = get_retry_after_seconds(e)
+            telegram_logger.info(f"Rate limited by Telegram, retrying after {retry_after}s")
+            await asyncio.sleep(retry_after)
+        except (TimedOut, NetworkError):
+            if attempt == REPLY_MAX_ATTEMPTS:
+                raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+# Reply with text of any length, split into ordered messages
+async def reply_long_text(message, text: str, message_thread_id, chunks: list = None):
+    chunks = chunks if chunks is not None else split_message(text)
+    for index, chunk in enumerate(chunks):
+        if index > 0 and not TELEGRAM_RATE_LIMIT:
+            # Stay under Telegram's per-chat message rate (the rate limiter does this when enabled)
+            await asyncio.sleep(REPLY_CHUNK_INTERVAL)
+        reply_params = {"text": chunk}
         if message_thread_id:
             reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent empty query warning")
-        return
+        with trace_span("telegram.send", part=index + 1, length=len(chunk)):
+            if index > 0:
+                # Follow-up parts yield to other chats' first replies
+                with bulk_sends():
+                    await send_with_retry(message.reply_text, **reply_params)
+            else:
+                await send_with_retry(message.reply_text, **reply_params)
+    if len(chunks) > 1:
+        telegram_logger.info(f"Sent reply in {len(chunks)} messages")
+
+# Edit a streamed message, returning False if Telegram asked us to back off
+async def edit_streamed_message(placeholder, text: str) -> bool:
+    try:
+        await placeholder.edit_text(text[:TELEGRAM_MAX_MESSAGE_LENGTH])
+        return True
+    except RetryAfter as e:
+        telegram_logger.info(f"Edit rate limited, retrying after {get_retry_after_seconds(e)}s")
+        return False
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return True
+        raise
+
+# Reply with a placeholder and progressively edit it with the streamed Grok response
+async def stream_reply(message, conversation: list, message_thread_id, search_mode: str = "auto") -> str:
+    reply_params = {"text": "…"}
+    if message_thread_id:
+        reply_params["message_thread_id"] = message_thread_id
+    placeholder = await message.reply_text(**reply_params)
     
-    redis_client = None
+    loop = asyncio.get_running_loop()
+    text = ""
+    sent_length = 0
+    next_flush = loop.time() + STREAM_EDIT_INTERVAL
+    async for text in grok_chat_stream(conversation, search_mode):
+        # Coalesce edits: flush at most once per interval, and only once enough new text arrived;
+        # past Telegram's limit the placeholder is left alone until the reply is split at the end
+        if loop.time() >= next_flush and len(text) - sent_length >= STREAM_EDIT_MIN_CHARS and sent_length < TELEGRAM_MAX_MESSAGE_LENGTH:
+            with bulk_sends():
+                edited = await edit_streamed_message(placeholder, text)
+            if edited:
+                sent_length = len(text)
+            next_flush = loop.time() + STREAM_EDIT_INTERVAL
+    
+    if not text:
+        raise Exception("Empty response from Grok")
+    # Final edit always carries the complete response (its first part if it has to be split)
+    chunks = split_message(text)
+    while not await edit_streamed_message(placeholder, chunks[0]):
+        await asyncio.sleep(STREAM_EDIT_INTERVAL)
+    if len(chunks) > 1:
+        if not TELEGRAM_RATE_LIMIT:
+            await asyncio.sleep(REPLY_CHUNK_INTERVAL)
+        await reply_long_text(message, text, message_thread_id, chunks[1:])
+    return text
+
+# Words that make a question depend on the preceding conversation
+CONTEXT_REFERENCE_PATTERN = re.compile(r"\b(it|its|this|that|these|those|he|she|him|her|they|them|their|above|previous|earlier|again|more)\b", re.IGNORECASE)
+
+# Build the /ask cache key, or None when the answer should not be cached
+def get_ask_cache_key(query: str, history: list):
+    if not ASK_CACHE:
+        return None
+    normalized = " ".join(query.lower().split()).rstrip("?!. ")
+    context_hash = ""
+    if history:
+        if ASK_CACHE_CONTEXT == "bypass":
+            return None
+        if ASK_CACHE_CONTEXT == "hash":
+            context_hash = hashlib.sha256(json.dumps([[msg["role"], msg["content"]] for msg in history]).encode()).hexdigest()
+        elif CONTEXT_REFERENCE_PATTERN.search(normalized):
+            return None
+    digest = hashlib.sha256(f"{GROK_MODEL}\n{context_hash}\n{normalized}".encode()).hexdigest()
+    return f"askcache:{digest}"
+
+# Look up a cached answer, in process first and then in the store
+async def get_cached_response(store, cache_key: str):
+    entry = ask_cache.get(cache_key)
+    if entry is not None:
+        response, expires_at = entry
+        if expires_at > time.time():
+            ask_cache.move_to_end(cache_key)
+            return response
+        del ask_cache[cache_key]
     try:
-        # Initialize Redis client for this request
-        redis_client = await init_redis()
-        # Initialize xAI SDK client
-        xai_client = Client(api_key=GROK_API_KEY, timeout=3600)
-        # Get conversation history
-        conversation_key = f"chat:{chat_id}:{message_thread_id or 'main'}"
-        conversation = await get_conversation_history(redis_client, conversation_key)
-        conversation.append({"role": "user", "content": query})
-        conversation.append({"role": "system", "content": [{"type": "text","text": "Your maximum output is 4096 characters."}]})
-
-        # Create chat session with search parameters
-        chat = xai_client.chat.create(
-            model=GROK_MODEL,
-            search_parameters=SearchParameters(mode="auto")
-        )
-        for msg in conversation:
-            if msg["role"] == "user":
-                chat.append(user(msg["content"]))
-            elif msg["role"] == "system":
-                chat.append(system(msg["content"][0]["text"]))
-            elif msg["role"] == "assistant":
-                chat.append(assistant(msg["content"]))
-
-        # Call Grok API with history
-        response = chat.sample()
-        grok_response = response.content
-        conversation.pop()
-        logger.info(f"Got response from Grok: {grok_response}")
+        with store_seconds.time(operation="ask_cache_get"):
+            response = await store.get(cache_key)
+    except Exception as e:
+        storage_logger.error(f"Error reading /ask cache: {str(e)}")
+        return None
+    if response is not None:
+        remember_cached_response(cache_key, response)
+    return response
+
+def remember_cached_response(cache_key: str, response: str):
+    ask_cache[cache_key] = (response, time.time() + ASK_CACHE_TTL)
+    ask_cache.move_to_end(cache_key)
+    while len(ask_cache) > ASK_CACHE_SIZE:
+        ask_cache.popitem(last=False)
+
+# Store an answer in both cache tiers
+async def store_cached_response(store, cache_key: str, response: str):
+    remember_cached_response(cache_key, response)
+    try:
+        with store_seconds.time(operation="ask_cache_set"):
+            await store.set(cache_key, response, ttl=ASK_CACHE_TTL)
+    except Exception as e:
+        storage_logger.error(f"Error writing /ask cache: {str(e)}")
+
+# Call the LLM once for concurrent identical questions and cache the answer
+async def cached_generate_reply(store, cache_key: str, conversation: list, search_mode: str = "auto") -> str:
+    inflight = ask_cache_inflight.get(cache_key)
+    if inflight is not None:
+        llm_logger.info("Joining in-flight /ask request")
+        return await asyncio.shield(inflight)
+    inflight = asyncio.ensure_future(generate_reply(conversation, search_mode))
+    ask_cache_inflight[cache_key] = inflight
+    try:
+        response = await asyncio.shield(inflight)
+    finally:
+        ask_cache_inflight.pop(cache_key, None)
+    await store_cached_response(store, cache_key, response)
+    return response
+
+# Matches the /command or /command@BotName at the start of a caption
+COMMAND_PREFIX_PATTERN = re.compile(r'^/\w+(@\w+)?')
+
+# Everything the handler pipeline knows about one incoming message
+class RequestContext:
+    def __init__(self, name: str, update: Update, context: ContextTypes.DEFAULT_TYPE, prompt_source: str):
+        self.name = name
+        self.update = update
+        self.context = context
+        self.message = update.message
+        self.chat_type = self.message.chat.type
+        self.chat_id = self.message.chat.id
+        self.user_id = self.message.from_user.id
+        self.message_thread_id = self.message.message_thread_id
+        self.conversation_key = f"chat:{self.chat_id}:{self.message_thread_id or 'main'}"
+        if prompt_source == "args":
+            self.prompt = ' '.join(context.args) if context.args else None
+        elif prompt_source == "caption":
+            # Drop the leading /command or /command@BotName from the caption
+            self.prompt = COMMAND_PREFIX_PATTERN.sub("", self.message.caption or "", count=1).strip()
+        else:
+            self.prompt = self.message.text
+        self.store = None
+        self.history = []
+        self.cache_key = None
+        # The assistant content to store in history once the reply has been delivered
+        self.reply_content = None
+        self.sent_message = None
+
+    # Reply with text in the message's thread
+    async def reply_text(self, text: str):
+        reply_params = {"text": text}
+        if self.message_thread_id:
+            reply_params["message_thread_id"] = self.message_thread_id
+        return await self.message.reply_text(**reply_params)
+
+    # Reply with a photo (URL, file_id or bytes) in the message's thread
+    async def reply_photo(self, photo):
+        reply_params = {"photo": photo}
+        if self.message_thread_id:
+            reply_params["message_thread_id"] = self.message_thread_id
+        kind = "url" if isinstance(photo, str) else "bytes"
+        with upload_seconds.time(kind=kind), trace_span("telegram.upload", kind=kind):
+            return await self.message.reply_photo(**reply_params)
+
+# Build a Telegram handler that runs each middleware around the next one and finally the action.
+# A middleware is async (request, call_next); it may stop the pipeline by returning without calling call_next.
+def build_handler(name: str, middlewares: list, action, prompt_source: str = "args"):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.message is None:
+            logger.info(f"Received /{name} update with no message content")
+            return
+        request = RequestContext(name, update, context, prompt_source)
         
-        # Save to conversation history
-        conversation.append({"role": "assistant", "content": grok_response})
-        await save_conversation_history(redis_client, conversation_key, conversation)
+        async def run(index: int):
+            if index == len(middlewares):
+                return await action(request)
+            return await middlewares[index](request, lambda: run(index + 1))
         
-        # Reply to Telegram
-        reply_params = {"text": grok_response}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info(f"Sent response to Telegram: {grok_response}")
-    except Exception as e:
-        logger.error(f"Error processing /ask command: {str(e)}")
-        reply_params = {"text": f"Error processing your request: {str(e)}"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent error message to Telegram")
+        await run(0)
+    
+    handler.__name__ = name
+    return handler
+
+# Middleware: time the whole handler
+async def measure(request: RequestContext, call_next):
+    updates_total.inc(handler=request.name)
+    started_at = time.perf_counter()
+    try:
+        with trace_span(f"handler.{request.name}"):
+            await call_next()
     finally:
-        if redis_client:
-            await redis_client.close()
-            logger.info("Redis client closed for /ask")
+        elapsed = time.perf_counter() - started_at
+        handler_seconds.observe(elapsed, handler=request.name)
+        logger.info(f"Handled /{request.name} in {elapsed:.3f}s")
 
-# Message handler for text messages
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message is None:
-        logger.info("Received update with no message content")
+# Middleware: only serve whitelisted chats and users
+async def authorize(request: RequestContext, call_next):
+    with trace_span("auth"):
+        whitelisted = is_whitelisted(request.chat_id, request.user_id)
+    if not whitelisted:
+        logger.info(f"Unauthorized access attempt: chat_id={request.chat_id}, user_id={request.user_id}")
+        await request.message.reply_text("Sorry, you are not authorized to use this bot.")
         return
-    message_text = update.message.text
-    chat_type = update.message.chat.type
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    message_thread_id = update.message.message_thread_id
+    await call_next()
+
+# Middleware: log the incoming message
+async def log_request(request: RequestContext, call_next):
+    if request.name == "message":
+        logger.info(f"Processing message from chat type {request.chat_type}, chat ID: {request.chat_id}, thread ID: {request.message_thread_id} ({len(request.prompt or '')} chars)")
+    else:
+        logger.info(f"Received /{request.name} command from chat type {request.chat_type}, chat ID: {request.chat_id}, thread ID: {request.message_thread_id} ({len(request.prompt or '')} chars)")
+    log_payload(logger, "Prompt", request.prompt)
+    await call_next()
+
+# Middleware factory: answer with usage_text when the command has no prompt
+def require_prompt(usage_text: str):
+    async def middleware(request: RequestContext, call_next):
+        if not request.prompt:
+            await request.reply_text(usage_text)
+            logger.info("Sent empty prompt warning")
+            return
+        await call_next()
+    return middleware
+
+# Middleware factory: report errors of the rest of the pipeline to the user as "<error_text>: <error>"
+def reply_errors(error_text: str):
+    async def middleware(request: RequestContext, call_next):
+        try:
+            await call_next()
+        except Exception as e:
+            errors_total.inc(handler=request.name)
+            logger.error(f"Error processing /{request.name}: {str(e)}")
+            await request.reply_text(f"{error_text}: {str(e)}")
+            logger.info("Sent error message to Telegram")
+    return middleware
+
+# Middleware: attach the storage backend
+async def with_store(request: RequestContext, call_next):
+    request.store = get_store()
+    await call_next()
+
+# Middleware: load the prompt history (cached summary plus the recent turns within the token budget)
+async def load_history(request: RequestContext, call_next):
+    with trace_span("store.history_load"):
+        request.history = await get_prompt_history(request.store, request.conversation_key)
+    await call_next()
+
+# Middleware factory: store the exchange in history once the reply was delivered.
+# with_command stores the user turn as "/<command> <prompt>", as image commands do.
+def save_history(with_command: bool = False):
+    async def middleware(request: RequestContext, call_next):
+        await call_next()
+        if request.reply_content is None:
+            return
+        user_content = f"/{request.name} {request.prompt}" if with_command else request.prompt
+        with trace_span("store.history_save"):
+            await append_conversation_history(request.store, request.conversation_key, [
+                {"role": "user", "content": user_content},
+                {"role": "assistant", "content": request.reply_content},
+            ])
+    return middleware
+
+# Middleware: answer repeated questions from the /ask cache
+async def answer_cache(request: RequestContext, call_next):
+    request.cache_key = get_ask_cache_key(request.prompt, request.history)
+    if request.cache_key:
+        with trace_span("store.ask_cache"):
+            cached = await get_cached_response(request.store, request.cache_key)
+        cache_lookups_total.inc(cache="ask", result="miss" if cached is None else "hit")
+        if cached is not None:
+            logger.info(f"Answered /{request.name} from cache ({len(cached)} chars)")
+            await reply_long_text(request.message, cached, request.message_thread_id)
+            request.reply_content = cached
+            return
+    await call_next()
+
+# Action: answer with the LLM, streaming the reply when possible
+async def answer_text(request: RequestContext):
+    conversation = request.history + [{"role": "user", "content": request.prompt}]
+    search_mode = select_search_mode(request.prompt, request.chat_id, is_command=request.name != "message")
     
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
+    if can_stream_replies():
+        # Stream the reply into Telegram; history is persisted once it is complete
+        with trace_span("provider.stream", provider="grok"):
+            grok_response = await stream_reply(request.message, conversation, request.message_thread_id, search_mode)
+        logger.info(f"Streamed response from Grok ({len(grok_response)} chars)")
+        log_payload(logger, "Response", grok_response)
+        if request.cache_key:
+            await store_cached_response(request.store, request.cache_key, grok_response)
+        request.reply_content = grok_response
         return
     
-    logger.info(f"Processing message from chat type {chat_type}, chat ID: {chat_id}, thread ID: {message_thread_id}: {message_text}")
+    if request.cache_key:
+        grok_response = await cached_generate_reply(request.store, request.cache_key, conversation, search_mode)
+    else:
+        grok_response = await generate_reply(conversation, search_mode)
+    log_payload(logger, "Response", grok_response)
     
-    redis_client = None
-    try:
-        # Initialize Redis client for this request
-        redis_client = await init_redis()
-        # Initialize xAI SDK client
-        xai_client = Client(api_key=GROK_API_KEY, timeout=3600)
-        # Get conversation history
-        conversation_key = f"chat:{chat_id}:{message_thread_id or 'main'}"
-        conversation = await get_conversation_history(redis_client, conversation_key)
-        conversation.append({"role": "user", "content": message_text})
-        conversation.append({"role": "system", "content": [{"type": "text","text": "Your maximum output is 4096 characters."}]})
-
-        # Create chat session with search parameters
-        chat = xai_client.chat.create(
-            model=GROK_MODEL,
-            search_parameters=SearchParameters(mode="auto")
-        )
-        for msg in conversation:
-            if msg["role"] == "user":
-                chat.append(user(msg["content"]))
-            elif msg["role"] == "system":
-                chat.append(system(msg["content"][0]["text"]))
-            elif msg["role"] == "assistant":
-                chat.append(assistant(msg["content"]))
-
-        # Call Grok API with history
-        response = chat.sample()
-        grok_response = response.content
-        conversation.pop()
-        logger.info(f"Got response from Grok: {grok_response}")
-        
-        # Save to conversation history
-        conversation.append({"role": "assistant", "content": grok_response})
-        await save_conversation_history(redis_client, conversation_key, conversation)
-        
-        # Reply to Telegram
-        reply_params = {"text": grok_response}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info(f"Sent response to Telegram: {grok_response}")
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}")
-        reply_params = {"text": f"Error processing your request: {str(e)}"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent error message to Telegram")
-    finally:
-        if redis_client:
-            await redis_client.close()
-            logger.info("Redis client closed for handle_message")
+    # Reply to Telegram, split into several messages if it is too long
+    await reply_long_text(request.message, grok_response, request.message_thread_id)
+    request.reply_content = grok_response
+    logger.info(f"Sent response to Telegram ({len(grok_response)} chars)")
+
+# Action: greet the user
+async def send_greeting(request: RequestContext):
+    await request.message.reply_text("Hello! I'm BahlulBot, powered by Grok. Use /ask <your question> to get a response, or send a message in private chat.")
+    logger.info("Sent /start response")
+
+# Command handler for /start
+start = build_handler("start", [authorize], send_greeting)
+
+# Command handler for /ask
+ask = build_handler("ask", [
+    measure,
+    authorize,
+    log_request,
+    require_prompt("Please provide a question after /ask (e.g., /ask What is the capital of France?)"),
+    reply_errors("Error processing your request"),
+    with_store,
+    load_history,
+    save_history(),
+    answer_cache,
+], answer_text)
+
+# Message handler for text messages
+handle_message = build_handler("message", [
+    measure,
+    authorize,
+    log_request,
+    reply_errors("Error processing your request"),
+    with_store,
+    load_history,
+    save_history(),
+], answer_text, prompt_source="text")
 
-# Initialize Redis client
+# Get the shared Redis client, creating its connection pool on first use
 async def init_redis():
+    global redis_client_shared, redis_client_loop
     if not REDIS_URL:
-        logger.warning("REDIS_URL not set, conversation history will not be stored")
+        redis_logger.warning("REDIS_URL not set, image slots are tracked in process")
         return None
     
+    loop = asyncio.get_running_loop()
+    if redis_client_shared is not None and redis_client_loop is loop:
+        return redis_client_shared
+    
     try:
         # Parse REDIS_URL to validate
         parsed_url = urlparse(REDIS_URL)
         if parsed_url.scheme not in ("redis", "rediss"):
-            logger.error(f"Invalid REDIS_URL scheme: {parsed_url.scheme}. Expected redis:// or rediss://")
+            redis_logger.error(f"Invalid REDIS_URL scheme: {parsed_url.scheme}. Expected redis:// or rediss://")
             return None
         
-        # Create Redis client (rediss:// handles TLS automatically)
-        redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-        # Test connection
-        # await redis_client.ping()
-        logger.info("Successfully connected to Redis")
-        return redis_client
+        # Create one pool per event loop (rediss:// handles TLS automatically);
+        # idle connections are health-checked lazily when they are next used
+        pool = redis.ConnectionPool.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        )
+        redis_client_shared = redis.Redis(connection_pool=pool)
+        redis_client_loop = loop
+        redis_logger.info("Created shared Redis connection pool")
+        return redis_client_shared
     except Exception as e:
-        logger.error(f"Failed to connect to Redis: {str(e)}")
+        redis_logger.error(f"Failed to connect to Redis: {str(e)}")
         return None
 
-# Function to get conversation history from Redis
-async def get_conversation_history(redis_client, conversation_key: str) -> list:
-    if redis_client is None:
-        logger.warning("Redis client not initialized, returning empty history")
-        return []
+# Close the shared Redis connection pool
+async def close_redis():
+    global redis_client_shared, redis_client_loop
+    if redis_client_shared is None:
+        return
     try:
-        history = await redis_client.get(conversation_key)
-        if history:
-            logger.info(f"Retrieved history for {conversation_key}: {history}")
-            return json.loads(history)
-        logger.info(f"No history found for {conversation_key}")
+        await redis_client_shared.aclose(close_connection_pool=True)
+        redis_logger.info("Shared Redis connection pool closed")
+    except Exception as e:
+        redis_logger.error(f"Error closing Redis connection pool: {str(e)}")
+    finally:
+        redis_client_shared = None
+        redis_client_loop = None
+
+# Storage backends for history, caches, dedupe keys and image slots. All of them offer the same small interface:
+# get/set/delete/expire on string keys, list_range/list_append/list_replace/list_drop_front on lists, and
+# acquire_slots/release_slots/leave_queue for image slots (shared through Redis, per process otherwise).
+# Values are strings and ttl is in seconds (None keeps the key until it is evicted or deleted).
+
+# Count how many of the given leading values are still at the front of a list. Concurrent appends may have trimmed
+# some of them already, so the longest tail of values that the list starts with is matched.
+def count_front_matches(items: list, values: list) -> int:
+    for offset in range(len(values)):
+        if items[:len(values) - offset] == values[offset:]:
+            return len(values) - offset
+    return 0
+
+# Redis version of list_drop_front: KEYS[1] is the list and ARGV the values expected at its front, oldest first.
+# Drops the longest tail of ARGV that the list starts with and returns how many items were dropped.
+DROP_FRONT_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, #ARGV - 1)
+for offset = 0, #ARGV - 1 do
+    local count = #ARGV - offset
+    local match = #items >= count
+    local i = 1
+    while match and i <= count do
+        match = items[i] == ARGV[offset + i]
+        i = i + 1
+    end
+    if match then
+        redis.call('LTRIM', KEYS[1], count, -1)
+        return count
+    end
+end
+return 0
+"""
+
+# Storage on the shared Redis pool
+class RedisStore:
+    name = "redis"
+
+    async def client(self):
+        redis_client = await init_redis()
+        if redis_client is None:
+            raise redis.ConnectionError("Redis is not available")
+        return redis_client
+
+    async def get(self, key: str):
+        return await (await self.client()).get(key)
+
+    async def set(self, key: str, value: str, ttl: int = None, nx: bool = False) -> bool:
+        return bool(await (await self.client()).set(key, value, ex=ttl, nx=nx))
+
+    async def delete(self, key: str):
+        await (await self.client()).delete(key)
+
+    async def expire(self, key: str, ttl: int):
+        await (await self.client()).expire(key, ttl)
+
+    async def list_range(self, key: str, count: int) -> list:
+        return await (await self.client()).lrange(key, -count, -1)
+
+    # Append, keep the last max_length items and refresh the expiry in one round-trip; returns the length before trimming
+    async def list_append(self, key: str, values: list, max_length: int, ttl: int) -> int:
+        async with (await self.client()).pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *values)
+            pipe.ltrim(key, -max_length, -1)
+            pipe.expire(key, ttl)
+            results = await pipe.execute()
+        return results[0]
+
+    async def list_replace(self, key: str, values: list, ttl: int):
+        async with (await self.client()).pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            if values:
+                pipe.rpush(key, *values)
+                pipe.expire(key, ttl)
+            await pipe.execute()
+
+    # Drop the given values from the front of a list, as far as they are still there; returns how many were dropped
+    async def list_drop_front(self, key: str, values: list) -> int:
+        if not values:
+            return 0
+        return await (await self.client()).eval(DROP_FRONT_SCRIPT, 1, key, *values)
+
+    # Image slots: see ACQUIRE_SLOTS_SCRIPT
+    async def acquire_slots(self, queue_key: str, global_key: str, keys: list, limits: list, token: str, enqueued_at: float) -> tuple:
+        acquired, position = await (await self.client()).eval(
+            ACQUIRE_SLOTS_SCRIPT, 2 + len(keys), queue_key, global_key, *keys,
+            time.time(), IMAGE_SLOT_TTL, token, enqueued_at, IMAGE_QUEUE_TIMEOUT, IMAGE_GLOBAL_LIMIT, *limits,
+        )
+        return bool(acquired), position
+
+    async def release_slots(self, keys: list, token: str):
+        async with (await self.client()).pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.zrem(key, token)
+            await pipe.execute()
+
+    async def leave_queue(self, queue_key: str, token: str):
+        await (await self.client()).zrem(queue_key, token)
+
+    async def close(self):
+        await close_redis()
+
+# In-process storage: an LRU of at most max_keys keys with per-key expiry, for single-process deployments
+class MemoryStore:
+    name = "memory"
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        # key -> [value, expires_at or None]; a value is a str or a list of str
+        self.entries = OrderedDict()
+
+    def lookup(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key: str, value, ttl: int = None):
+        self.entries[key] = [value, time.time() + ttl if ttl else None]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str):
+        entry = self.lookup(key)
+        return entry[0] if entry is not None and isinstance(entry[0], str) else None
+
+    async def set(self, key: str, value: str, ttl: int = None, nx: bool = False) -> bool:
+        if nx and self.lookup(key) is not None:
+            return False
+        self.store(key, value, ttl)
+        return True
+
+    async def delete(self, key: str):
+        self.entries.pop(key, None)
+
+    async def expire(self, key: str, ttl: int):
+        entry = self.lookup(key)
+        if entry is not None:
+            entry[1] = time.time() + ttl
+
+    async def list_range(self, key: str, count: int) -> list:
+        entry = self.lookup(key)
+        if entry is None or not isinstance(entry[0], list):
+            return []
+        return entry[0][-count:]
+
+    async def list_append(self, key: str, values: list, max_length: int, ttl: int) -> int:
+        entry = self.lookup(key)
+        items = (entry[0] if entry is not None and isinstance(entry[0], list) else []) + list(values)
+        self.store(key, items[-max_length:], ttl)
+        return len(items)
+
+    async def list_replace(self, key: str, values: list, ttl: int):
+        if values:
+            self.store(key, list(values), ttl)
+        else:
+            self.entries.pop(key, None)
+
+    async def list_drop_front(self, key: str, values: list) -> int:
+        entry = self.lookup(key)
+        if entry is None or not isinstance(entry[0], list):
+            return 0
+        count = count_front_matches(entry[0], list(values))
+        entry[0] = entry[0][count:]
+        return count
+
+    # Image slots are tracked in process
+    async def acquire_slots(self, queue_key: str, global_key: str, keys: list, limits: list, token: str, enqueued_at: float) -> tuple:
+        return acquire_local_slots(queue_key, global_key, keys, limits, token, enqueued_at)
+
+    async def release_slots(self, keys: list, token: str):
+        release_local_slots(keys, token)
+
+    async def leave_queue(self, queue_key: str, token: str):
+        leave_local_queue(queue_key, token)
+
+    async def close(self):
+        pass
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL);
+CREATE TABLE IF NOT EXISTS lists (key TEXT PRIMARY KEY, expires_at REAL);
+CREATE TABLE IF NOT EXISTS list_items (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, value TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS list_items_key ON list_items (key, id);
+"""
+
+# On-disk storage in a SQLite database in WAL mode, for single-node deployments that keep history across restarts.
+# Queries run in a worker thread, one transaction at a time.
+class SqliteStore:
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    async def run(self, function, *args):
+        return await asyncio.to_thread(self.run_sync, function, *args)
+
+    def run_sync(self, function, *args):
+        with self.lock:
+            if self.connection is None:
+                import sqlite3
+                self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.executescript(SQLITE_SCHEMA)
+                storage_logger.info(f"Opened SQLite store {self.path}")
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(self.connection, *args)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+
+    @staticmethod
+    def expires_at(ttl):
+        return time.time() + ttl if ttl else None
+
+    # Drop expired keys now and then, so keys that are never read again don't pile up
+    @staticmethod
+    def purge_expired(connection):
+        if random.random() >= 0.01:
+            return
+        now = time.time()
+        connection.execute("DELETE FROM kv WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM list_items WHERE key IN (SELECT key FROM lists WHERE expires_at <= ?)", (now,))
+        connection.execute("DELETE FROM lists WHERE expires_at <= ?", (now,))
+
+    @staticmethod
+    def get_sync(connection, key):
+        row = connection.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= time.time():
+            connection.execute("DELETE FROM kv WHERE key = ?", (key,))
+            return None
+        return row[0]
+
+    # Whether a list exists and has not expired, deleting it if it has
+    @staticmethod
+    def list_alive(connection, key) -> bool:
+        row = connection.execute("SELECT expires_at FROM lists WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        if row[0] is not None and row[0] <= time.time():
+            connection.execute("DELETE FROM lists WHERE key = ?", (key,))
+            connection.execute("DELETE FROM list_items WHERE key = ?", (key,))
+            return False
+        return True
+
+    async def get(self, key: str):
+        return await self.run(self.get_sync, key)
+
+    async def set(self, key: str, value: str, ttl: int = None, nx: bool = False) -> bool:
+        def set_sync(connection):
+            if nx and self.get_sync(connection, key) is not None:
+                return False
+            connection.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, value, self.expires_at(ttl)))
+            self.purge_expired(connection)
+            return True
+        return await self.run(set_sync)
+
+    async def delete(self, key: str):
+        def delete_sync(connection):
+            connection.execute("DELETE FROM kv WHERE key = ?", (key,))
+            connection.execute("DELETE FROM lists WHERE key = ?", (key,))
+            connection.execute("DELETE FROM list_items WHERE key = ?", (key,))
+        await self.run(delete_sync)
+
+    async def expire(self, key: str, ttl: int):
+        def expire_sync(connection):
+            connection.execute("UPDATE kv SET expires_at = ? WHERE key = ?", (self.expires_at(ttl), key))
+            connection.execute("UPDATE lists SET expires_at = ? WHERE key = ?", (self.expires_at(ttl), key))
+        await self.run(expire_sync)
+
+    async def list_range(self, key: str, count: int) -> list:
+        def list_range_sync(connection):
+            if not self.list_alive(connection, key):
+                return []
+            rows = connection.execute("SELECT value FROM list_items WHERE key = ? ORDER BY id DESC LIMIT ?", (key, count)).fetchall()
+            return [row[0] for row in reversed(rows)]
+        return await self.run(list_range_sync)
+
+    async def list_append(self, key: str, values: list, max_length: int, ttl: int) -> int:
+        def list_append_sync(connection):
+            self.list_alive(connection, key)
+            connection.executemany("INSERT INTO list_items (key, value) VALUES (?, ?)", [(key, value) for value in values])
+            connection.execute("INSERT OR REPLACE INTO lists (key, expires_at) VALUES (?, ?)", (key, self.expires_at(ttl)))
+            length = connection.execute("SELECT COUNT(*) FROM list_items WHERE key = ?", (key,)).fetchone()[0]
+            if length > max_length:
+                connection.execute(
+                    "DELETE FROM list_items WHERE id IN (SELECT id FROM list_items WHERE key = ? ORDER BY id LIMIT ?)",
+                    (key, length - max_length),
+                )
+            self.purge_expired(connection)
+            return length
+        return await self.run(list_append_sync)
+
+    async def list_replace(self, key: str, values: list, ttl: int):
+        def list_replace_sync(connection):
+            connection.execute("DELETE FROM list_items WHERE key = ?", (key,))
+            connection.execute("DELETE FROM lists WHERE key = ?", (key,))
+            if values:
+                connection.executemany("INSERT INTO list_items (key, value) VALUES (?, ?)", [(key, value) for value in values])
+                connection.execute("INSERT INTO lists (key, expires_at) VALUES (?, ?)", (key, self.expires_at(ttl)))
+        await self.run(list_replace_sync)
+
+    async def list_drop_front(self, key: str, values: list) -> int:
+        def list_drop_front_sync(connection):
+            rows = connection.execute(
+                "SELECT id, value FROM list_items WHERE key = ? ORDER BY id LIMIT ?", (key, len(values))
+            ).fetchall()
+            count = count_front_matches([value for _, value in rows], list(values))
+            connection.executemany("DELETE FROM list_items WHERE id = ?", [(row_id,) for row_id, _ in rows[:count]])
+            return count
+        return await self.run(list_drop_front_sync)
+
+    # Image slots are tracked in process
+    async def acquire_slots(self, queue_key: str, global_key: str, keys: list, limits: list, token: str, enqueued_at: float) -> tuple:
+        return acquire_local_slots(queue_key, global_key, keys, limits, token, enqueued_at)
+
+    async def release_slots(self, keys: list, token: str):
+        release_local_slots(keys, token)
+
+    async def leave_queue(self, queue_key: str, token: str):
+        leave_local_queue(queue_key, token)
+
+    async def close(self):
+        def close_sync():
+            with self.lock:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+        await asyncio.to_thread(close_sync)
+
+# Storage on a primary backend that switches to a fallback for a while whenever the primary can't be reached
+class FallbackStore:
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name} with {fallback.name} fallback"
+        self.retry_at = 0
+
+    async def run(self, operation: str, *args, **kwargs):
+        if time.monotonic() >= self.retry_at:
+            try:
+                return await getattr(self.primary, operation)(*args, **kwargs)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                storage_logger.warning(f"{self.primary.name} unavailable, using {self.fallback.name} storage for {STORAGE_FALLBACK_RETRY_INTERVAL:g}s: {str(e)}")
+                self.retry_at = time.monotonic() + STORAGE_FALLBACK_RETRY_INTERVAL
+        return await getattr(self.fallback, operation)(*args, **kwargs)
+
+    async def get(self, key: str):
+        return await self.run("get", key)
+
+    async def set(self, key: str, value: str, ttl: int = None, nx: bool = False) -> bool:
+        return await self.run("set", key, value, ttl=ttl, nx=nx)
+
+    async def delete(self, key: str):
+        await self.run("delete", key)
+
+    async def expire(self, key: str, ttl: int):
+        await self.run("expire", key, ttl)
+
+    async def list_range(self, key: str, count: int) -> list:
+        return await self.run("list_range", key, count)
+
+    async def list_append(self, key: str, values: list, max_length: int, ttl: int) -> int:
+        return await self.run("list_append", key, values, max_length, ttl)
+
+    async def list_replace(self, key: str, values: list, ttl: int):
+        await self.run("list_replace", key, values, ttl)
+
+    async def list_drop_front(self, key: str, values: list) -> int:
+        return await self.run("list_drop_front", key, values)
+
+    async def acquire_slots(self, queue_key: str, global_key: str, keys: list, limits: list, token: str, enqueued_at: float) -> tuple:
+        return await self.run("acquire_slots", queue_key, global_key, keys, limits, token, enqueued_at)
+
+    async def release_slots(self, keys: list, token: str):
+        await self.run("release_slots", keys, token)
+
+    async def leave_queue(self, queue_key: str, token: str):
+        await self.run("leave_queue", queue_key, token)
+
+    async def close(self):
+        await self.primary.close()
+        await self.fallback.close()
+
+# Get the configured storage backend ("auto" uses Redis when REDIS_URL is set, falling back to memory
+# while Redis is unreachable, and memory otherwise)
+def get_store():
+    global store_shared
+    if store_shared is None:
+        backend = STORAGE_BACKEND
+        if backend == "auto" and REDIS_URL:
+            store_shared = FallbackStore(RedisStore(), MemoryStore(STORAGE_MEMORY_MAX_KEYS))
+        elif backend == "redis":
+            store_shared = RedisStore()
+        elif backend == "sqlite":
+            store_shared = SqliteStore(STORAGE_SQLITE_PATH)
+        else:
+            store_shared = MemoryStore(STORAGE_MEMORY_MAX_KEYS)
+        storage_logger.info(f"Using {store_shared.name} storage")
+    return store_shared
+
+# Close the storage backend
+async def close_store():
+    global store_shared
+    if store_shared is not None:
+        await store_shared.close()
+        store_shared = None
+
+# Rough token estimate for a message (about 4 characters per token plus role overhead)
+def estimate_tokens(message: dict) -> int:
+    content = message["content"]
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content)
+    return len(content) // 4 + 4
+
+# Get orjson if it is installed, or None to use the json module
+def get_orjson():
+    global orjson_module
+    if orjson_module is None:
+        try:
+            import orjson
+            orjson_module = orjson
+        except ImportError:
+            orjson_module = False
+    return orjson_module or None
+
+# Serialize to compact UTF-8 JSON
+def dump_compact_json(value) -> bytes:
+    orjson = get_orjson()
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+# Parse JSON text or UTF-8 bytes
+def load_json(data):
+    orjson = get_orjson()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+# History entry formats, told apart by the first character:
+# "{" legacy JSON, "1" compact JSON, "2" base64 of zlib-compressed compact JSON
+HISTORY_ENTRY_COMPACT = "1"
+HISTORY_ENTRY_COMPRESSED = "2"
+
+# Serialize a message for storage, caching its token estimate
+def encode_history_entry(message: dict) -> str:
+    entry = dict(message)
+    entry.setdefault("tokens", estimate_tokens(message))
+    if HISTORY_ENCODING == "json":
+        return json.dumps(entry)
+    data = dump_compact_json(entry)
+    if len(data) >= HISTORY_COMPRESS_MIN_BYTES:
+        compressed = base64.b64encode(zlib.compress(data, 6))
+        # Base64 adds a third, so short or already dense entries can come out larger
+        if len(compressed) < len(data):
+            return HISTORY_ENTRY_COMPRESSED + compressed.decode()
+    return HISTORY_ENTRY_COMPACT + data.decode()
+
+# Deserialize a stored message in any of the history entry formats
+def decode_history_entry(entry: str) -> dict:
+    if entry.startswith(HISTORY_ENTRY_COMPRESSED):
+        return load_json(zlib.decompress(base64.b64decode(entry[1:])))
+    if entry.startswith(HISTORY_ENTRY_COMPACT):
+        return load_json(entry[1:])
+    return load_json(entry)
+
+# Function to get conversation history from the store
+async def get_conversation_history(store, conversation_key: str) -> list:
+    try:
+        try:
+            with store_seconds.time(operation="history_get"):
+                entries = await store.list_range(conversation_key, HISTORY_MAX_MESSAGES)
+        except redis.ResponseError as e:
+            if "WRONGTYPE" not in str(e):
+                raise
+            # History written to Redis before the list format: convert it in place
+            legacy = await store.get(conversation_key)
+            conversation = json.loads(legacy) if legacy else []
+            await save_conversation_history(store, conversation_key, conversation)
+            storage_logger.info(f"Converted legacy history for {conversation_key}")
+            return conversation[-HISTORY_MAX_MESSAGES:]
+        if entries:
+            conversation = [decode_history_entry(entry) for entry in entries]
+            storage_logger.info(f"Retrieved {len(conversation)} messages for {conversation_key}")
+            return conversation
+        storage_logger.info(f"No history found for {conversation_key}")
         return []
     except Exception as e:
-        logger.error(f"Error retrieving conversation history for {conversation_key}: {str(e)}")
+        storage_logger.error(f"Error retrieving conversation history for {conversation_key}: {str(e)}")
         return []
 
-# Function to save conversation history to Redis
-async def save_conversation_history(redis_client, conversation_key: str, conversation: list):
-    if redis_client is None:
-        logger.warning("Redis client not initialized, skipping history save")
-        return
+# Keep the most recent messages that fit in the token budget
+def select_history_within_budget(conversation: list, token_budget: int) -> list:
+    selected = []
+    used = 0
+    for message in reversed(conversation):
+        tokens = message.get("tokens") or estimate_tokens(message)
+        if used + tokens > token_budget:
+            break
+        selected.append(message)
+        used += tokens
+    selected.reverse()
+    return selected
+
+# Function to replace the stored conversation history
+async def save_conversation_history(store, conversation_key: str, conversation: list):
     try:
-        # Limit history to last 10 messages to avoid token limits
-        conversation = conversation[-10:]
-        await redis_client.set(conversation_key, json.dumps(conversation))
-        # Set expiry to 1 hour to manage storage
-        await redis_client.expire(conversation_key, 3600)
-        logger.info(f"Saved conversation history for {conversation_key}: {json.dumps(conversation)}")
+        conversation = conversation[-HISTORY_MAX_MESSAGES:]
+        await store.list_replace(conversation_key, [encode_history_entry(message) for message in conversation], HISTORY_TTL)
+        storage_logger.info(f"Saved {len(conversation)} messages for {conversation_key}")
     except Exception as e:
-        logger.error(f"Error saving conversation history for {conversation_key}: {str(e)}")
+        storage_logger.error(f"Error saving conversation history for {conversation_key}: {str(e)}")
 
-# Command handler for /generate
-async def generate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message is None:
-        logger.info("Received /generate command with no message content")
-        return
-    
-    chat_type = update.message.chat.type
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    message_thread_id = update.message.message_thread_id
-    prompt = ' '.join(context.args) if context.args else None
-    
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
-    logger.info(f"Received /generate command from chat type {chat_type}, chat ID: {chat_id}, thread ID: {message_thread_id}, prompt: {prompt}")
-    
-    if not prompt:
-        reply_params = {"text": "Please provide a description after /generate (e.g., /generate A cat in a tree)"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent empty prompt warning")
-        return
-    
-    redis_client = None
+# Append messages to the stored conversation history, trimming it and refreshing its expiry in one step
+async def append_conversation_history(store, conversation_key: str, messages: list):
     try:
-        # Initialize Redis client
-        redis_client = await init_redis()
-        # Initialize xAI SDK client
-        xai_client = Client(api_key=GROK_API_KEY, timeout=3600)
-        # Get conversation history
-        conversation_key = f"chat:{chat_id}:{message_thread_id or 'main'}"
-        conversation = await get_conversation_history(redis_client, conversation_key)
-        conversation.append({"role": "user", "content": f"/generate {prompt}"})
-        
-        # Generate image using xAI SDK
-        response = xai_client.image.sample(
-            model="grok-2-image",
-            prompt=prompt,
-            image_format="url"
-        )
-        image_url = response.url
-        revised_prompt = response.prompt
-        logger.info(f"Generated image with revised prompt: {revised_prompt}, URL: {image_url}")
-        
-        # Save to conversation history
-        conversation.append({"role": "assistant", "content": f"Generated image: {image_url} (Revised prompt: {revised_prompt})"})
-        await save_conversation_history(redis_client, conversation_key, conversation)
-        
-        # Send image to Telegram
-        reply_params = {"photo": image_url}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_photo(**reply_params)
-        logger.info(f"Sent image to Telegram: {image_url}")
+        entries = [encode_history_entry(message) for message in messages]
+        with store_seconds.time(operation="history_append"):
+            if HISTORY_SUMMARY:
+                # The summary stands in for turns already dropped from the list, so it must live as long as the list
+                length, _ = await asyncio.gather(
+                    store.list_append(conversation_key, entries, HISTORY_MAX_MESSAGES, HISTORY_TTL),
+                    store.expire(f"{conversation_key}:summary", HISTORY_TTL),
+                )
+            else:
+                length = await store.list_append(conversation_key, entries, HISTORY_MAX_MESSAGES, HISTORY_TTL)
+        storage_logger.info(f"Appended {len(messages)} messages to {conversation_key}")
+        if HISTORY_SUMMARY and length > HISTORY_SUMMARY_THRESHOLD:
+            schedule_background(refresh_conversation_summary(store, conversation_key))
+    except redis.ResponseError as e:
+        if "WRONGTYPE" not in str(e):
+            storage_logger.error(f"Error appending conversation history for {conversation_key}: {str(e)}")
+            return
+        conversation = await get_conversation_history(store, conversation_key)
+        await save_conversation_history(store, conversation_key, conversation + messages)
     except Exception as e:
-        logger.error(f"Error processing /generate command: {str(e)}")
-        reply_params = {"text": f"Error generating image: {str(e)}"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent error message to Telegram")
-    finally:
-        if redis_client:
-            await redis_client.close()
-            logger.info("Redis client closed for /generate")
+        storage_logger.error(f"Error appending conversation history for {conversation_key}: {str(e)}")
 
-# Command handler for /draw
-async def draw(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message is None:
-        logger.info("Received /draw command with no message content")
-        return
-    
-    chat_type = update.message.chat.type
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    message_thread_id = update.message.message_thread_id
-    prompt = ' '.join(context.args) if context.args else None
-    
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
-    logger.info(f"Received /draw command from chat type {chat_type}, chat ID: {chat_id}, thread ID: {message_thread_id}, prompt: {prompt}")
-    
-    if not prompt:
-        reply_params = {"text": "Please provide a description after /draw (e.g., /draw A cute baby sea otter)"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent empty prompt warning")
-        return
-    
-    redis_client = None
+# Run a coroutine in the background, keeping a reference until it finishes
+def schedule_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Function to get the cached summary of older turns
+async def get_conversation_summary(store, conversation_key: str):
     try:
-        # Initialize Redis client
-        redis_client = await init_redis()
-        # Initialize OpenAI client
-        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-        # Get conversation history
-        conversation_key = f"chat:{chat_id}:{message_thread_id or 'main'}"
-        conversation = await get_conversation_history(redis_client, conversation_key)
-        conversation.append({"role": "user", "content": f"/draw {prompt}"})
-        
-        # Generate image using OpenAI
-        response = await openai_client.images.generate(
-            model="gpt-image-1",
-            prompt=prompt,
-            n=1,
-            size="1024x1024",
-            quality="low",
-            moderation="low"
-        )
-        
-        image_base64 = response.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
-        
-        logger.info(f"Generated image with prompt: {prompt}")
-        
-        # Save to conversation history
-        conversation.append({"role": "assistant", "content": f"Generated image with prompt: {prompt}"})
-        await save_conversation_history(redis_client, conversation_key, conversation)
-        
-        # Send image to Telegram
-        reply_params = {"photo": image_bytes}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_photo(**reply_params)
-        logger.info(f"Sent image to Telegram (base64 length: {len(image_base64)})")
+        with store_seconds.time(operation="summary_get"):
+            return await store.get(f"{conversation_key}:summary")
     except Exception as e:
-        logger.error(f"Error processing /draw command: {str(e)}")
-        reply_params = {"text": f"Error generating image: {str(e)}"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent error message to Telegram")
-    finally:
-        if redis_client:
-            await redis_client.close()
-            logger.info("Redis client closed for /draw")
+        storage_logger.error(f"Error retrieving conversation summary for {conversation_key}: {str(e)}")
+        return None
 
-# Command handler for /gooddraw
-async def gooddraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message is None:
-        logger.info("Received /gooddraw command with no message content")
-        return
-    
-    chat_type = update.message.chat.type
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    message_thread_id = update.message.message_thread_id
-    prompt = ' '.join(context.args) if context.args else None
-    
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
-    logger.info(f"Received /gooddraw command from chat type {chat_type}, chat ID: {chat_id}, thread ID: {message_thread_id}, prompt: {prompt}")
-    
-    if not prompt:
-        reply_params = {"text": "Please provide a description after /gooddraw (e.g., /gooddraw A cute baby sea otter)"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent empty prompt warning")
-        return
-    
-    redis_client = None
+# Fold all but the most recent turns into the cached summary and drop them from the history
+async def refresh_conversation_summary(store, conversation_key: str):
+    summary_key = f"{conversation_key}:summary"
+    lock_key = f"{summary_key}:lock"
     try:
-        # Initialize Redis client
-        redis_client = await init_redis()
-        # Initialize OpenAI client
-        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-        # Get conversation history
-        conversation_key = f"chat:{chat_id}:{message_thread_id or 'main'}"
-        conversation = await get_conversation_history(redis_client, conversation_key)
-        conversation.append({"role": "user", "content": f"/gooddraw {prompt}"})
-        
-        # Generate image using OpenAI
-        response = await openai_client.images.generate(
-            model="gpt-image-1",
-            prompt=prompt,
-            n=1,
-            size="1024x1024",
-            quality="auto",
-            moderation="low"
-        )
-        
-        image_base64 = response.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
-        
-        logger.info(f"Generated image with prompt: {prompt}")
-        
-        # Save to conversation history
-        conversation.append({"role": "assistant", "content": f"Generated image with prompt: {prompt}"})
-        await save_conversation_history(redis_client, conversation_key, conversation)
-        
-        # Send image to Telegram
-        reply_params = {"photo": image_bytes}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_photo(**reply_params)
-        logger.info(f"Sent image to Telegram (base64 length: {len(image_base64)})")
+        if not await store.set(lock_key, "1", ttl=int(GROK_CHAT_TIMEOUT) + 30, nx=True):
+            return
+        try:
+            entries = await store.list_range(conversation_key, HISTORY_MAX_MESSAGES)
+            old_entries = entries[:-HISTORY_SUMMARY_KEEP]
+            if len(entries) <= HISTORY_SUMMARY_THRESHOLD or not old_entries:
+                return
+            old_turns = [decode_history_entry(entry) for entry in old_entries]
+            previous_summary = await get_conversation_summary(store, conversation_key)
+            transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in old_turns if msg["role"] != "system")
+            if previous_summary:
+                transcript = f"Earlier summary: {previous_summary}\n{transcript}"
+            summary = await generate_reply([
+                {"role": "system", "content": [{"type": "text", "text": "Summarize this conversation in a few short paragraphs, keeping names, facts and open questions. Reply with the summary only."}]},
+                {"role": "user", "content": transcript},
+            ], search_mode="off")
+            # Store the summary, then drop the summarized entries by value, not by count: appends made meanwhile
+            # may have trimmed some of them already, and the turns after them must be kept
+            await store.set(summary_key, summary, ttl=HISTORY_TTL)
+            dropped = await store.list_drop_front(conversation_key, old_entries)
+            storage_logger.info(f"Summarized {len(old_turns)} messages for {conversation_key}, dropped {dropped}")
+        finally:
+            await store.delete(lock_key)
     except Exception as e:
-        logger.error(f"Error processing /gooddraw command: {str(e)}")
-        reply_params = {"text": f"Error generating image: {str(e)}"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent error message to Telegram")
-    finally:
-        if redis_client:
-            await redis_client.close()
-            logger.info("Redis client closed for /gooddraw")
-
-# Command handler for /edit
-async def edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global telegram_app
-    webhook_info = await telegram_app.bot.get_webhook_info()
-    if webhook_info.pending_update_count > 1:
-        logger.info(f"Pending updates found: {webhook_info.pending_update_count}. Returning 200 immediately.")
-        return
-    if update.message is None:
-        logger.info("Received /edit command with no message content")
-        return
-    
-    chat_type = update.message.chat.type
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    message_thread_id = update.message.message_thread_id
-    caption = update.message.caption
-    
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
-    logger.info(f"Received /edit command from chat type {chat_type}, chat ID: {chat_id}, thread ID: {message_thread_id}, caption: {caption}")
-    
-    # Extract prompt from caption
-    prompt_start = len("/edit@BahlulBot") if caption.lower().startswith("/edit@bahlulbot") else len("/edit")
-    prompt = caption[prompt_start:].strip()
-    photo = update.message.photo[-1]  # Get the highest resolution photo
+        storage_logger.error(f"Error summarizing conversation history for {conversation_key}: {str(e)}")
+
+# Build the history part of a prompt: the cached summary, then the most recent turns within the token budget
+async def get_prompt_history(store, conversation_key: str) -> list:
+    history = await get_conversation_history(store, conversation_key)
+    if not HISTORY_SUMMARY:
+        return select_history_within_budget(history, HISTORY_TOKEN_BUDGET)
+    summary = await get_conversation_summary(store, conversation_key)
+    if not summary:
+        return select_history_within_budget(history, HISTORY_TOKEN_BUDGET)
+    summary_message = {"role": "system", "content": [{"type": "text", "text": f"Summary of the earlier conversation: {summary}"}]}
+    conversation = select_history_within_budget(history, HISTORY_TOKEN_BUDGET - estimate_tokens(summary_message))
+    return [summary_message] + conversation
+
+# Atomically take a slot in every semaphore key, in arrival order. KEYS[1] is the wait queue, KEYS[2] the global
+# semaphore and KEYS[3..] the per-chat and per-user ones. A request blocked by its own chat or user limit stays out
+# of the queue; otherwise it queues by arrival time and only the first (free global slots) waiters may take a slot.
+# Returns {1, 0} when acquired, {0, position} while queued, and {0, 0} while blocked by a chat or user limit.
+ACQUIRE_SLOTS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local token = ARGV[3]
+local enqueued_at = tonumber(ARGV[4])
+local queue_timeout = tonumber(ARGV[5])
+local global_limit = tonumber(ARGV[6])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - queue_timeout)
+for i = 2, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+end
+for i = 3, #KEYS do
+    if redis.call('ZCARD', KEYS[i]) >= tonumber(ARGV[4 + i]) then
+        redis.call('ZREM', KEYS[1], token)
+        return {0, 0}
+    end
+end
+local first = 3
+if global_limit > 0 then
+    redis.call('ZADD', KEYS[1], 'NX', enqueued_at, token)
+    redis.call('EXPIRE', KEYS[1], queue_timeout)
+    local rank = redis.call('ZRANK', KEYS[1], token)
+    if rank >= global_limit - redis.call('ZCARD', KEYS[2]) then
+        return {0, rank + 1}
+    end
+    redis.call('ZREM', KEYS[1], token)
+    first = 2
+end
+for i = first, #KEYS do
+    redis.call('ZADD', KEYS[i], now + ttl, token)
+    redis.call('EXPIRE', KEYS[i], ttl)
+end
+return {1, 0}
+"""
+
+# Drop expired holders of an in-process semaphore and return the rest
+def get_local_holders(key: str, now: float) -> dict:
+    holders = local_slots.setdefault(key, {})
+    for holder, expires_at in list(holders.items()):
+        if expires_at <= now:
+            del holders[holder]
+    return holders
+
+# In-process version of ACQUIRE_SLOTS_SCRIPT, for the memory and SQLite stores: try to take the global slot
+# (queue_key orders its waiters) and the per-chat and per-user slots, owned by token.
+# Returns (acquired, position) with position 0 while a chat or user limit is the one blocking.
+def acquire_local_slots(queue_key: str, global_key: str, keys: list, limits: list, token: str, enqueued_at: float) -> tuple:
+    now = time.time()
+    waiters = local_slot_waiters.setdefault(queue_key, {})
+    for key, limit in zip(keys, limits):
+        if len(get_local_holders(key, now)) >= limit:
+            waiters.pop(token, None)
+            return False, 0
+    acquired_keys = list(keys)
+    if IMAGE_GLOBAL_LIMIT > 0:
+        waiters.setdefault(token, enqueued_at)
+        rank = sorted(waiters, key=waiters.get).index(token)
+        if rank >= IMAGE_GLOBAL_LIMIT - len(get_local_holders(global_key, now)):
+            return False, rank + 1
+        del waiters[token]
+        acquired_keys.append(global_key)
+    for key in acquired_keys:
+        local_slots.setdefault(key, {})[token] = now + IMAGE_SLOT_TTL
+    return True, 0
+
+# Release the in-process slots owned by token
+def release_local_slots(keys: list, token: str):
+    for key in keys:
+        local_slots.get(key, {}).pop(token, None)
+
+# Remove token from an in-process wait queue
+def leave_local_queue(queue_key: str, token: str):
+    local_slot_waiters.get(queue_key, {}).pop(token, None)
+
+# Hold a global, per-chat and per-user slot for an expensive job, queueing with position feedback while full
+@asynccontextmanager
+async def concurrency_slot(kind: str, message, chat_id: int, user_id: int, message_thread_id):
+    store = get_store()
+    token = uuid.uuid4().hex
+    global_key = f"slots:{kind}"
+    keys = []
+    limits = []
+    for key, limit in ((f"slots:{kind}:chat:{chat_id}", IMAGE_CHAT_LIMIT), (f"slots:{kind}:user:{user_id}", IMAGE_USER_LIMIT)):
+        if limit > 0:
+            keys.append(key)
+            limits.append(limit)
     
-    redis_client = None
+    queue_key = f"slots:{kind}:waiting"
+    queue_message = None
+    position = None
+    enqueued_at = time.time()
     try:
-        # Initialize Redis client
-        redis_client = await init_redis()
-        if redis_client is not None:
-            # Attempt to set 'is_editing' to '1' only if it doesn't exist, with 60s expiration
-            set_result = await redis_client.set('is_editing', '1', nx=True, ex=60)
-            if not set_result:
-                logger.info("Another edit is in progress, skipping this request")
-                return
-        else:
-            logger.warning("Redis is not available, proceeding without edit lock")
-        
-        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-        
-        # Get the photo file
-        file = await photo.get_file()
-        file_url = file.file_path
-
-        # Download the image
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as resp:
-                if resp.status != 200:
-                    raise Exception(f"Failed to download image: HTTP {resp.status}")
-                image_data = await resp.read()
-
-        image_file = io.BytesIO(image_data)
-        image_file.name = "image.png"
-
-        # Make request to OpenAI Image Edit API
-        response = await openai_client.images.edit(
-            model="gpt-image-1",
-            image=image_file,
-            prompt=prompt,
-            n=1,
-            quality='low',
-            size='1024x1024'
-        )
-        
-        image_base64 = response.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
-        
-        logger.info("Successfully received response from image edit")
-        reply_params = {"photo": image_bytes}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_photo(**reply_params)
-        logger.info(f"Sent edited image to Telegram (base64 length: {len(image_base64)})")
-        
-    except Exception as e:
-        logger.error(f"Error processing /edit command: {str(e)}")
-        reply_params = {"text": f"Error editing image: {str(e)}"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent error message to Telegram")
+        while True:
+            acquired, new_position = await store.acquire_slots(queue_key, global_key, keys, limits, token, enqueued_at)
+            if acquired:
+                break
+            if position is None:
+                slot_contention_total.inc(kind=kind)
+            if time.time() - enqueued_at > IMAGE_QUEUE_TIMEOUT:
+                raise Exception("Too many requests in progress, please try again later")
+            if new_position != position:
+                position = new_position
+                if position:
+                    text = f"Another request is in progress. You are #{position} in the queue."
+                else:
+                    text = "An earlier request from you or this chat is still in progress. This one starts when it finishes."
+                try:
+                    with bulk_sends():
+                        if queue_message is None:
+                            reply_params = {"text": text}
+                            if message_thread_id:
+                                reply_params["message_thread_id"] = message_thread_id
+                            queue_message = await message.reply_text(**reply_params)
+                        else:
+                            await queue_message.edit_text(text)
+                except Exception as e:
+                    redis_logger.warning(f"Could not send queue position: {str(e)}")
+            await asyncio.sleep(1)
     finally:
-        if redis_client is not None:
-            await redis_client.delete('is_editing')
-            await redis_client.close()
-            logger.info("Redis client closed and 'is_editing' key deleted")
-
-# Command handler for /goodedit
-async def goodedit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global telegram_app
-    webhook_info = await telegram_app.bot.get_webhook_info()
-    if webhook_info.pending_update_count > 1:
-        logger.info(f"Pending updates found: {webhook_info.pending_update_count}. Returning 200 immediately.")
-        return
-    if update.message is None:
-        logger.info("Received /edit command with no message content")
-        return
+        if position is not None:
+            await store.leave_queue(queue_key, token)
+        if queue_message is not None:
+            try:
+                await queue_message.delete()
+            except Exception as e:
+                redis_logger.warning(f"Could not delete queue message: {str(e)}")
     
-    chat_type = update.message.chat.type
-    chat_id = update.message.chat.id
-    user_id = update.message.from_user.id
-    message_thread_id = update.message.message_thread_id
-    caption = update.message.caption
-    
-    if not is_whitelisted(chat_id, user_id):
-        logger.info(f"Unauthorized access attempt: chat_id={chat_id}, user_id={user_id}")
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
+    queue_wait_seconds.observe(time.time() - enqueued_at, queue=kind)
+    redis_logger.info(f"Acquired {kind} slot for chat {chat_id}, user {user_id}")
+    try:
+        yield
+    finally:
+        await store.release_slots(keys + [global_key], token)
+        redis_logger.info(f"Released {kind} slot for chat {chat_id}, user {user_id}")
+
+# Build the image cache key, or None when the image cache is disabled
+def get_image_cache_key(provider: str, model: str, quality: str, size: str, prompt: str):
+    if not IMAGE_CACHE:
+        return None
+    normalized = " ".join(prompt.lower().split())
+    digest = hashlib.sha256(f"{provider}\n{model}\n{quality}\n{size}\n{normalized}".encode()).hexdigest()
+    return f"imagecache:{digest}"
+
+# Reply with a cached image if there is one, returning its history content when the request was answered
+async def reply_cached_image(message, store, cache_key, message_thread_id):
+    if cache_key is None:
+        return None
+    try:
+        with store_seconds.time(operation="image_cache_get"):
+            cached = await store.get(cache_key)
+    except Exception as e:
+        storage_logger.error(f"Error reading image cache: {str(e)}")
+        return None
+    if not cached:
+        return None
+    try:
+        cached = json.loads(cached)
+        reply_params = {"photo": cached["file_id"]}
+        content = cached["content"]
+    except Exception as e:
+        # A corrupt entry counts as a miss; drop it so the regenerated image replaces it
+        storage_logger.warning(f"Discarding unreadable image cache entry {cache_key}: {str(e)}")
+        try:
+            await store.delete(cache_key)
+        except Exception as e:
+            storage_logger.error(f"Error deleting image cache entry: {str(e)}")
+        return None
+    if message_thread_id:
+        reply_params["message_thread_id"] = message_thread_id
+    try:
+        with upload_seconds.time(kind="file_id"), trace_span("telegram.upload", kind="file_id"):
+            await message.reply_photo(**reply_params)
+    except BadRequest as e:
+        # The file_id is no longer usable; forget it and generate a new image
+        storage_logger.warning(f"Cached image could not be sent, regenerating: {str(e)}")
+        await store.delete(cache_key)
+        return None
+    # Refresh the TTL so frequently requested images stay cached
+    await store.expire(cache_key, IMAGE_CACHE_TTL)
+    storage_logger.info(f"Sent cached image to Telegram: {reply_params['photo']}")
+    return content
+
+# Remember the file_id Telegram assigned to an uploaded image
+async def store_cached_image(store, cache_key, sent_message, assistant_content: str):
+    if cache_key is None or not sent_message.photo:
         return
+    try:
+        cached = {"file_id": sent_message.photo[-1].file_id, "content": assistant_content}
+        with store_seconds.time(operation="image_cache_set"):
+            await store.set(cache_key, json.dumps(cached), ttl=IMAGE_CACHE_TTL)
+    except Exception as e:
+        storage_logger.error(f"Error writing image cache: {str(e)}")
+
+# Get the shared OpenAI client for the running loop
+def get_openai_client():
+    global openai_client_shared, openai_client_loop
+    loop = asyncio.get_running_loop()
+    if openai_client_shared is None or openai_client_loop is not loop:
+        from openai import AsyncOpenAI
+        openai_client_shared = AsyncOpenAI(api_key=OPENAI_API_KEY)
+        openai_client_loop = loop
+        llm_logger.info("Created shared OpenAI client")
+    return openai_client_shared
+
+# Close the shared OpenAI client
+async def close_openai_client():
+    global openai_client_shared, openai_client_loop
+    if openai_client_shared is not None:
+        await openai_client_shared.close()
+    openai_client_shared = None
+    openai_client_loop = None
+
+# Import Pillow if it is installed, returning its Image module or None
+def get_pil_image():
+    global pil_image_module
+    if pil_image_module is None:
+        try:
+            from PIL import Image
+            pil_image_module = Image
+        except ImportError:
+            pil_image_module = False
+    return pil_image_module or None
+
+# Get the shared aiohttp session for the running loop
+def get_http_session():
+    global http_session, http_session_loop
+    loop = asyncio.get_running_loop()
+    if http_session is None or http_session.closed or http_session_loop is not loop:
+        import aiohttp
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        http_session_loop = loop
+    return http_session
+
+# Close the shared aiohttp session
+async def close_http_session():
+    global http_session, http_session_loop
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+    http_session_loop = None
+
+# Downscale and re-encode an image to fit max_dimension (runs in a worker thread)
+def downscale_image(image_file: io.BytesIO, max_dimension: int) -> io.BytesIO:
+    with get_pil_image().open(image_file) as image:
+        if max(image.size) <= max_dimension:
+            image_file.seek(0)
+            return image_file
+        image.thumbnail((max_dimension, max_dimension))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=90)
+    output.seek(0)
+    output.name = "image.jpg"
+    return output
+
+# Stream a Telegram photo into memory, enforcing MEDIA_MAX_BYTES, and prepare it for upload
+async def download_telegram_photo(photo) -> io.BytesIO:
+    if photo.file_size and photo.file_size > MEDIA_MAX_BYTES:
+        raise Exception(f"Image is too large ({photo.file_size} bytes, limit {MEDIA_MAX_BYTES})")
+    with trace_span("telegram.download"):
+        image_file = await fetch_telegram_photo(photo)
     
-    logger.info(f"Received /goodedit command from chat type {chat_type}, chat ID: {chat_id}, thread ID: {message_thread_id}, caption: {caption}")
+    if MEDIA_MAX_DIMENSION > 0 and get_pil_image() is not None:
+        with trace_span("decode.downscale"):
+            image_file = await asyncio.to_thread(downscale_image, image_file, MEDIA_MAX_DIMENSION)
+    return image_file
+
+# Stream a Telegram photo into memory, enforcing MEDIA_MAX_BYTES
+async def fetch_telegram_photo(photo) -> io.BytesIO:
+    file = await photo.get_file()
     
-    # Extract prompt from caption
-    prompt_start = len("/goodedit@BahlulBot") if caption.lower().startswith("/goodedit@bahlulbot") else len("/goodedit")
-    prompt = caption[prompt_start:].strip()
-    photo = update.message.photo[-1]  # Get the highest resolution photo
+    image_file = io.BytesIO()
+    async with get_http_session().get(file.file_path) as resp:
+        if resp.status != 200:
+            raise Exception(f"Failed to download image: HTTP {resp.status}")
+        if resp.content_length and resp.content_length > MEDIA_MAX_BYTES:
+            raise Exception(f"Image is too large ({resp.content_length} bytes, limit {MEDIA_MAX_BYTES})")
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            if image_file.tell() + len(chunk) > MEDIA_MAX_BYTES:
+                raise Exception(f"Image is too large (limit {MEDIA_MAX_BYTES} bytes)")
+            image_file.write(chunk)
+    image_file.seek(0)
+    image_file.name = "image.png"
+    return image_file
+
+# Middleware: hold an image concurrency slot, queueing with position feedback while all slots are taken
+async def image_slot(request: RequestContext, call_next):
+    async with concurrency_slot("image", request.message, request.chat_id, request.user_id, request.message_thread_id):
+        await call_next()
+
+# Middleware factory: answer repeated prompts by resending the cached Telegram file, and cache new uploads
+def image_cache(provider: str, model: str, quality: str, size: str):
+    async def middleware(request: RequestContext, call_next):
+        cache_key = get_image_cache_key(provider, model, quality, size, request.prompt)
+        with trace_span("store.image_cache"):
+            cached_content = await reply_cached_image(request.message, request.store, cache_key, request.message_thread_id)
+        if cache_key is not None:
+            cache_lookups_total.inc(cache="image", result="miss" if cached_content is None else "hit")
+        if cached_content is not None:
+            request.reply_content = cached_content
+            return
+        await call_next()
+        if request.sent_message is not None:
+            await store_cached_image(request.store, cache_key, request.sent_message, request.reply_content)
+    return middleware
+
+# Action: generate an image with Grok and send it by URL
+async def send_grok_image(request: RequestContext):
+    response = await grok_image(request.prompt)
+    image_url = response.url
+    revised_prompt = response.prompt
+    logger.info(f"Generated image with Grok: {image_url}")
+    log_payload(logger, "Revised prompt", revised_prompt)
     
-    redis_client = None
-    try:
-        # Initialize Redis client
-        redis_client = await init_redis()
-        if redis_client is not None:
-            # Attempt to set 'is_editing' to '1' only if it doesn't exist, with 60s expiration
-            set_result = await redis_client.set('is_editing', '1', nx=True, ex=60)
-            if not set_result:
-                logger.info("Another edit is in progress, skipping this request")
-                return
-        else:
-            logger.warning("Redis is not available, proceeding without edit lock")
-        
-        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    request.sent_message = await request.reply_photo(image_url)
+    request.reply_content = f"Generated image: {image_url} (Revised prompt: {revised_prompt})"
+    logger.info(f"Sent image to Telegram: {image_url}")
+
+# Decode a base64 image in a worker thread so multi-MB images don't stall the event loop
+async def decode_image(image_base64: str) -> bytes:
+    with trace_span("decode", size=len(image_base64)):
+        return await asyncio.to_thread(base64.b64decode, image_base64)
+
+# Action factory: generate an image with OpenAI at the given quality and upload it
+def send_openai_image(quality: str):
+    async def action(request: RequestContext):
+        with provider_seconds.time(provider="openai", kind="image"), trace_span("provider.image", provider="openai"):
+            response = await get_openai_client().images.generate(
+                model="gpt-image-1",
+                prompt=request.prompt,
+                n=1,
+                size="1024x1024",
+                quality=quality,
+                moderation="low"
+            )
+        image_base64 = response.data[0].b64_json
+        image_bytes = await decode_image(image_base64)
+        logger.info("Generated image with OpenAI")
         
-        # Get the photo file
-        file = await photo.get_file()
-        file_url = file.file_path
-
-        # Download the image
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as resp:
-                if resp.status != 200:
-                    raise Exception(f"Failed to download image: HTTP {resp.status}")
-                image_data = await resp.read()
-
-        image_file = io.BytesIO(image_data)
-        image_file.name = "image.png"
-
-        # Make request to OpenAI Image Edit API
-        response = await openai_client.images.edit(
-            model="gpt-image-1",
-            image=image_file,
-            prompt=prompt,
-            n=1,
-            quality='auto',
-            size='1024x1024',
-            input_fidelity='high'
-        )
+        request.sent_message = await request.reply_photo(image_bytes)
+        request.reply_content = f"Generated image with prompt: {request.prompt}"
+        logger.info(f"Sent image to Telegram (base64 length: {len(image_base64)})")
+    return action
+
+# Action factory: edit the attached photo with OpenAI and upload the result
+def send_openai_edit(quality: str, **options):
+    async def action(request: RequestContext):
+        photo = request.message.photo[-1]  # Get the highest resolution photo
+        image_file = await download_telegram_photo(photo)
         
+        with provider_seconds.time(provider="openai", kind="edit"), trace_span("provider.edit", provider="openai"):
+            response = await get_openai_client().images.edit(
+                model="gpt-image-1",
+                image=image_file,
+                prompt=request.prompt,
+                n=1,
+                quality=quality,
+                size='1024x1024',
+                **options
+            )
         image_base64 = response.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
-        
+        image_bytes = await decode_image(image_base64)
         logger.info("Successfully received response from image edit")
-        reply_params = {"photo": image_bytes}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_photo(**reply_params)
-        logger.info(f"Sent edited image to Telegram (base64 length: {len(image_base64)})")
         
-    except Exception as e:
-        logger.error(f"Error processing /edit command: {str(e)}")
-        reply_params = {"text": f"Error editing image: {str(e)}"}
-        if message_thread_id:
-            reply_params["message_thread_id"] = message_thread_id
-        await update.message.reply_text(**reply_params)
-        logger.info("Sent error message to Telegram")
+        await request.reply_photo(image_bytes)
+        logger.info(f"Sent edited image to Telegram (base64 length: {len(image_base64)})")
+    return action
+
+# Command handler for /generate
+generate = build_handler("generate", [
+    measure,
+    authorize,
+    log_request,
+    require_prompt("Please provide a description after /generate (e.g., /generate A cat in a tree)"),
+    reply_errors("Error generating image"),
+    with_store,
+    save_history(with_command=True),
+    image_cache("xai", "grok-2-image", "default", "default"),
+    image_slot,
+], send_grok_image)
+
+# Command handler for /draw
+draw = build_handler("draw", [
+    measure,
+    authorize,
+    log_request,
+    require_prompt("Please provide a description after /draw (e.g., /draw A cute baby sea otter)"),
+    reply_errors("Error generating image"),
+    with_store,
+    save_history(with_command=True),
+    image_cache("openai", "gpt-image-1", "low", "1024x1024"),
+    image_slot,
+], send_openai_image("low"))
+
+# Command handler for /gooddraw
+gooddraw = build_handler("gooddraw", [
+    measure,
+    authorize,
+    log_request,
+    require_prompt("Please provide a description after /gooddraw (e.g., /gooddraw A cute baby sea otter)"),
+    reply_errors("Error generating image"),
+    with_store,
+    save_history(with_command=True),
+    image_cache("openai", "gpt-image-1", "auto", "1024x1024"),
+    image_slot,
+], send_openai_image("auto"))
+
+# Handler for photos captioned /edit
+edit = build_handler("edit", [
+    measure,
+    authorize,
+    log_request,
+    require_prompt("Please describe the change in the caption (e.g., /edit Make it a watercolor painting)"),
+    reply_errors("Error editing image"),
+    image_slot,
+], send_openai_edit("low"), prompt_source="caption")
+
+# Handler for photos captioned /goodedit
+goodedit = build_handler("goodedit", [
+    measure,
+    authorize,
+    log_request,
+    require_prompt("Please describe the change in the caption (e.g., /goodedit Make it a watercolor painting)"),
+    reply_errors("Error editing image"),
+    image_slot,
+], send_openai_edit("auto", input_fidelity="high"), prompt_source="caption")
+
+# Mark Telegram requests made inside this block as bulk, so interactive replies go first
+@contextmanager
+def bulk_sends():
+    token = send_priority.set("bulk")
+    try:
+        yield
     finally:
-        if redis_client is not None:
-            await redis_client.delete('is_editing')
-            await redis_client.close()
-            logger.info("Redis client closed and 'is_editing' key deleted")
+        send_priority.reset(token)
 
-# Initialize bot for each request
-async def initialize_bot():
-    global telegram_app
+# Token bucket that lets interactive requests take tokens ahead of waiting bulk requests
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.interactive_waiting = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, priority: str):
+        interactive = priority == "interactive"
+        if interactive:
+            self.interactive_waiting += 1
+        try:
+            while True:
+                self.refill()
+                if self.tokens >= 1 and (interactive or self.interactive_waiting == 0):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max((1 - self.tokens) / self.rate, 0.05))
+        finally:
+            if interactive:
+                self.interactive_waiting -= 1
+
+    def is_idle(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity and self.interactive_waiting == 0
+
+# Central outbound scheduler for the Bot API: global and per-chat token buckets, and RetryAfter handling
+class TelegramRateLimiter(BaseRateLimiter):
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_GLOBAL_PER_SECOND)
+        self.chat_buckets = {}
+        self.group_buckets = {}
+        self.blocked_until = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self.chat_buckets.clear()
+        self.group_buckets.clear()
+
+    def get_bucket(self, buckets: dict, chat_id, rate: float, capacity: float) -> TokenBucket:
+        bucket = buckets.get(chat_id)
+        if bucket is None:
+            if len(buckets) > 10000:
+                # Forget chats whose buckets are full again
+                for idle_chat_id in [key for key, value in buckets.items() if value.is_idle()]:
+                    del buckets[idle_chat_id]
+            bucket = buckets[chat_id] = TokenBucket(rate, capacity)
+        return bucket
+
+    async def wait_for_slot(self, chat_id, priority: str):
+        # Honor an earlier RetryAfter for all chats, then for this chat
+        for key in (None, chat_id):
+            delay = self.blocked_until.get(key, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if chat_id is None:
+            return
+        await self.get_bucket(self.chat_buckets, chat_id, RATE_LIMIT_CHAT_PER_SECOND, 1).acquire(priority)
+        # Negative chat ids are groups, supergroups and channels
+        if isinstance(chat_id, str) or chat_id < 0:
+            await self.get_bucket(self.group_buckets, chat_id, RATE_LIMIT_GROUP_PER_MINUTE / 60, RATE_LIMIT_GROUP_PER_MINUTE).acquire(priority)
+        await self.global_bucket.acquire(priority)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        priority = send_priority.get()
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            await self.wait_for_slot(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == RATE_LIMIT_MAX_RETRIES:
+                    raise
+                retry_after = get_retry_after_seconds(e)
+                self.blocked_until[chat_id] = time.monotonic() + retry_after
+                telegram_logger.info(f"{endpoint} rate limited for chat {chat_id}, retrying after {retry_after}s")
+
+# Register all update handlers on the application
+def register_handlers(application):
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("ask", ask))
+    application.add_handler(CommandHandler("generate", generate))
+    application.add_handler(CommandHandler("draw", draw))
+    application.add_handler(CommandHandler("gooddraw", gooddraw))
+    application.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(re.compile(r'^/goodedit(@BahlulBot)?\b.*', re.IGNORECASE)) & ~filters.VIA_BOT,goodedit))
+    application.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(re.compile(r'^/edit(@BahlulBot)?\b.*', re.IGNORECASE)) & ~filters.VIA_BOT,edit))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(record_handler_error)
+    telegram_logger.info("Bot handlers added")
+
+# Error handler: PTB catches handler exceptions, so remember them for process_update_once to re-raise
+async def record_handler_error(update, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(update, Update):
+        handler_errors[update.update_id] = context.error
+    else:
+        telegram_logger.error(f"Unhandled error outside an update: {str(context.error)}")
+
+# Build and initialize a new Telegram application
+async def build_bot():
     if not TOKEN:
-        logger.error("TELEGRAM_TOKEN is not set")
+        telegram_logger.error("TELEGRAM_TOKEN is not set")
         raise ValueError("TELEGRAM_TOKEN is not set")
     
-    telegram_app = (
+    builder = (
         Application.builder()
         .token(TOKEN)
-        .build()
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .concurrent_updates(True)
     )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    if TELEGRAM_RATE_LIMIT:
+        builder = builder.rate_limiter(TelegramRateLimiter())
+    application = builder.build()
     
     # Initialize the application
-    logger.info("Initializing Telegram application")
-    await telegram_app.initialize()
-    
-    # Add handlers
-    telegram_app.add_handler(CommandHandler("start", start))
-    telegram_app.add_handler(CommandHandler("ask", ask))
-    telegram_app.add_handler(CommandHandler("generate", generate))
-    telegram_app.add_handler(CommandHandler("draw", draw))
-    telegram_app.add_handler(CommandHandler("gooddraw", gooddraw))
-    telegram_app.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(re.compile(r'^/goodedit(@BahlulBot)?\b.*', re.IGNORECASE)) & ~filters.VIA_BOT,goodedit))
-    telegram_app.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(re.compile(r'^/edit(@BahlulBot)?\b.*', re.IGNORECASE)) & ~filters.VIA_BOT,edit))
-    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    telegram_logger.info("Initializing Telegram application")
+    with telegram_init_seconds.time():
+        await application.initialize()
+    register_handlers(application)
+    return application
+
+# Get the Telegram application, building it on first use in "warm" mode
+async def initialize_bot():
+    global telegram_app, telegram_app_loop, telegram_app_lock, telegram_app_lock_loop
+    if BOT_LIFECYCLE != "warm":
+        telegram_app = await build_bot()
+        return telegram_app
     
-    logger.info("Bot handlers added")
+    loop = asyncio.get_running_loop()
+    # An asyncio.Lock is bound to the loop it was first contended on, so each loop gets its own
+    if telegram_app_lock is None or telegram_app_lock_loop is not loop:
+        telegram_app_lock = asyncio.Lock()
+        telegram_app_lock_loop = loop
+    async with telegram_app_lock:
+        # The HTTP pool is bound to the loop it was created on, so rebuild if the loop changed
+        if telegram_app is not None and telegram_app_loop is not loop:
+            telegram_logger.info("Event loop changed, rebuilding Telegram application")
+            await shutdown_bot()
+        if telegram_app is None:
+            telegram_app = await build_bot()
+            telegram_app_loop = loop
     return telegram_app
 
-# Webhook endpoint
-@app.post("/webhook")
-async def telegram_webhook(request: Request):
-    global telegram_app
+# Shut down the Telegram application and release its HTTP pool
+async def shutdown_bot():
+    global telegram_app, telegram_app_loop
+    if telegram_app is None:
+        return
     try:
-        telegram_app = await initialize_bot()
-        update_json = await request.json()
-        logger.info(f"Received update: {update_json}")
-        update = Update.de_json(update_json, telegram_app.bot)
-
-        # Process updates synchronously
-        await telegram_app.process_update(update)
-        logger.info("Update processed successfully")
         await telegram_app.shutdown()
-        return Response(status_code=200)
+        telegram_logger.info("Telegram application shut down")
     except Exception as e:
-        logger.error(f"Webhook error: {str(e)}")
-        await telegram_app.shutdown()
-        return Response(content=f"Error: {str(e)}", status_code=500)
+        telegram_logger.error(f"Error shutting down Telegram application: {str(e)}")
+    finally:
+        telegram_app = None
+        telegram_app_loop = None
+
+# Remember an update_id in the in-process LRU
+def remember_update_id(update_id: int):
+    seen_update_ids[update_id] = True
+    seen_update_ids.move_to_end(update_id)
+    while len(seen_update_ids) > DEDUPE_LRU_SIZE:
+        seen_update_ids.popitem(last=False)
+
+# Claim an update for processing, returning False if it was already processed or is in flight
+async def claim_update(update_id: int) -> bool:
+    if update_id in seen_update_ids:
+        return False
+    remember_update_id(update_id)
+    try:
+        with store_seconds.time(operation="dedupe_claim"):
+            return await get_store().set(f"update:{update_id}", "inflight", ttl=DEDUPE_INFLIGHT_TTL, nx=True)
+    except Exception as e:
+        storage_logger.error(f"Error claiming update {update_id}: {str(e)}")
+        return True
+
+# Mark a claimed update as processed
+async def complete_update(update_id: int):
+    try:
+        with store_seconds.time(operation="dedupe_complete"):
+            await get_store().set(f"update:{update_id}", "done", ttl=DEDUPE_TTL)
+    except Exception as e:
+        storage_logger.error(f"Error completing update {update_id}: {str(e)}")
+
+# Keep an in-flight claim alive while its update is processed, so a long job (waiting for an image slot, generating) is not replayed
+async def keep_update_claimed(update_id: int):
+    while True:
+        await asyncio.sleep(DEDUPE_INFLIGHT_TTL / 3)
+        try:
+            await get_store().expire(f"update:{update_id}", DEDUPE_INFLIGHT_TTL)
+        except Exception as e:
+            storage_logger.error(f"Error renewing claim on update {update_id}: {str(e)}")
+
+# Release a claimed update after a failure so a retry can process it
+async def release_update(update_id: int):
+    seen_update_ids.pop(update_id, None)
+    try:
+        await get_store().delete(f"update:{update_id}")
+    except Exception as e:
+        storage_logger.error(f"Error releasing update {update_id}: {str(e)}")
+
+# Process an update unless it is a replay of one already processed or in flight
+async def process_update_once(application, update: Update):
+    chat = update.effective_chat
+    with log_scope(update.update_id, chat.id if chat else None), trace_span("process_update", update_id=update.update_id, chat_id=chat.id if chat else None):
+        if not await claim_update(update.update_id):
+            logger.info(f"Dropping duplicate update {update.update_id}")
+            return
+        heartbeat = asyncio.create_task(keep_update_claimed(update.update_id))
+        try:
+            await application.process_update(update)
+            # A handler failure that was not answered with an error reply fails the update, so it is retried
+            error = handler_errors.pop(update.update_id, None)
+            if error is not None:
+                raise error
+        except Exception:
+            await release_update(update.update_id)
+            raise
+        finally:
+            heartbeat.cancel()
+        await complete_update(update.update_id)
+
+# In-process update queue, used when no Redis is available and as a stand-in for tests
+class LocalJobQueue:
+    def __init__(self, partitions: int):
+        self.queues = [asyncio.Queue() for _ in range(partitions)]
+        self.leases = [{} for _ in range(partitions)]
+        self.attempts = {}
+
+    async def enqueue(self, partition: int, job: dict):
+        await self.queues[partition].put(json.dumps(job))
+
+    async def reserve(self, partition: int, timeout: float):
+        try:
+            raw = await asyncio.wait_for(self.queues[partition].get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.leases[partition][raw] = time.time() + QUEUE_VISIBILITY_TIMEOUT
+        return raw
+
+    async def ack(self, partition: int, raw: str):
+        self.leases[partition].pop(raw, None)
+        self.attempts.pop(json.loads(raw)["id"], None)
+
+    # Count a delivery of a job, returning how many it has had
+    async def attempt(self, job_id: str) -> int:
+        self.attempts[job_id] = self.attempts.get(job_id, 0) + 1
+        return self.attempts[job_id]
+
+    # A single process consumes the local queue, so its workers always own their partitions
+    async def claim_partition(self, partition: int, owner: str) -> bool:
+        return True
+
+    async def release_partition(self, partition: int, owner: str):
+        pass
+
+    # Push back the lease of a job that is still being processed
+    async def extend(self, partition: int, raw: str):
+        if raw in self.leases[partition]:
+            self.leases[partition][raw] = time.time() + QUEUE_VISIBILITY_TIMEOUT
+
+    async def requeue_expired(self, partition: int):
+        now = time.time()
+        for raw, deadline in list(self.leases[partition].items()):
+            if deadline <= now:
+                del self.leases[partition][raw]
+                await self.queues[partition].put(raw)
+
+# Take or renew ownership of a partition: only the owner consumes it, so a chat's updates run in order across instances
+CLAIM_PARTITION_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) and 1 or 0
+"""
+
+RELEASE_PARTITION_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Reliable update queue on Redis lists: jobs move to a processing list while leased
+class RedisJobQueue:
+    def __init__(self, partitions: int):
+        self.partitions = partitions
+
+    def keys(self, partition: int):
+        base = f"updates:{partition}"
+        return base, f"{base}:processing", f"{base}:leases"
+
+    async def enqueue(self, partition: int, job: dict):
+        redis_client = await init_redis()
+        queue_key, _, _ = self.keys(partition)
+        await redis_client.lpush(queue_key, json.dumps(job))
+
+    async def reserve(self, partition: int, timeout: float):
+        redis_client = await init_redis()
+        queue_key, processing_key, leases_key = self.keys(partition)
+        raw = await redis_client.blmove(queue_key, processing_key, timeout, "RIGHT", "LEFT")
+        if raw is not None:
+            await redis_client.zadd(leases_key, {raw: time.time() + QUEUE_VISIBILITY_TIMEOUT})
+        return raw
+
+    async def ack(self, partition: int, raw: str):
+        redis_client = await init_redis()
+        _, processing_key, leases_key = self.keys(partition)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.lrem(processing_key, 1, raw)
+            pipe.zrem(leases_key, raw)
+            pipe.delete(f"updates:attempts:{json.loads(raw)['id']}")
+            await pipe.execute()
+
+    # Count a delivery of a job in Redis, so the count survives redelivery to another process
+    async def attempt(self, job_id: str) -> int:
+        redis_client = await init_redis()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.incr(f"updates:attempts:{job_id}")
+            pipe.expire(f"updates:attempts:{job_id}", QUEUE_VISIBILITY_TIMEOUT * (QUEUE_MAX_ATTEMPTS + 1))
+            results = await pipe.execute()
+        return results[0]
+
+    async def requeue_expired(self, partition: int):
+        redis_client = await init_redis()
+        queue_key, processing_key, leases_key = self.keys(partition)
+        expired = await redis_client.zrangebyscore(leases_key, "-inf", time.time())
+        for raw in expired:
+            # Push back on the consuming end so the job is retried before newer ones
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.lrem(processing_key, 1, raw)
+                pipe.rpush(queue_key, raw)
+                pipe.zrem(leases_key, raw)
+                await pipe.execute()
+            queue_logger.info(f"Requeued expired job on partition {partition}")
+
+    async def claim_partition(self, partition: int, owner: str) -> bool:
+        redis_client = await init_redis()
+        return bool(await redis_client.eval(CLAIM_PARTITION_SCRIPT, 1, f"updates:{partition}:owner", owner, int(QUEUE_OWNER_TTL * 1000)))
+
+    async def release_partition(self, partition: int, owner: str):
+        redis_client = await init_redis()
+        await redis_client.eval(RELEASE_PARTITION_SCRIPT, 1, f"updates:{partition}:owner", owner)
+
+    async def extend(self, partition: int, raw: str):
+        redis_client = await init_redis()
+        _, _, leases_key = self.keys(partition)
+        await redis_client.zadd(leases_key, {raw: time.time() + QUEUE_VISIBILITY_TIMEOUT}, xx=True)
+
+# Find the chat an update belongs to, so updates of one chat land on one partition
+def get_update_chat_id(update_json: dict):
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post", "callback_query"):
+        payload = update_json.get(key)
+        if not isinstance(payload, dict):
+            continue
+        if key == "callback_query":
+            payload = payload.get("message") or {}
+        chat = payload.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+def get_update_partition(update_json: dict) -> int:
+    chat_id = get_update_chat_id(update_json)
+    key = str(chat_id if chat_id is not None else update_json.get("update_id"))
+    return zlib.crc32(key.encode()) % QUEUE_PARTITIONS
+
+# Get the update queue for the configured mode
+def get_update_queue():
+    global update_queue
+    if update_queue is None:
+        if UPDATE_QUEUE_MODE == "redis":
+            update_queue = RedisJobQueue(QUEUE_PARTITIONS)
+        else:
+            update_queue = LocalJobQueue(QUEUE_PARTITIONS)
+    return update_queue
+
+# Queue an update for background processing
+async def enqueue_update(update_json: dict):
+    job = {"id": uuid.uuid4().hex, "enqueued_at": time.time(), "update": update_json}
+    partition = get_update_partition(update_json)
+    await get_update_queue().enqueue(partition, job)
+    queue_logger.info(f"Queued update {update_json.get('update_id')} on partition {partition}")
+
+# Renew the partition ownership and the job's lease while a job is being processed
+async def keep_job_leased(queue, partition: int, owner: str, raw: str):
+    while True:
+        await asyncio.sleep(QUEUE_OWNER_TTL / 3)
+        try:
+            if not await queue.claim_partition(partition, owner):
+                queue_logger.warning(f"Lost ownership of partition {partition} while processing a job")
+            await queue.extend(partition, raw)
+        except Exception as e:
+            queue_logger.error(f"Could not renew the lease on partition {partition}: {str(e)}")
+
+# Process queued updates of one partition in order (at-least-once), while this worker owns the partition
+async def update_worker(partition: int):
+    queue = get_update_queue()
+    owner = uuid.uuid4().hex
+    queue_logger.info(f"Update worker started for partition {partition}")
+    try:
+        while update_workers_running:
+            raw = None
+            try:
+                if not await queue.claim_partition(partition, owner):
+                    # Another instance consumes this partition; take over if its ownership lapses
+                    await asyncio.sleep(QUEUE_OWNER_TTL / 3)
+                    continue
+                await queue.requeue_expired(partition)
+                raw = await queue.reserve(partition, timeout=1)
+                if raw is None:
+                    continue
+                job = json.loads(raw)
+                queue_wait_seconds.observe(time.time() - job["enqueued_at"], queue="updates")
+                if await queue.attempt(job["id"]) > QUEUE_MAX_ATTEMPTS:
+                    queue_logger.error(f"Dropping job {job['id']} after {QUEUE_MAX_ATTEMPTS} attempts")
+                else:
+                    application = await initialize_bot()
+                    heartbeat = asyncio.create_task(keep_job_leased(queue, partition, owner, raw))
+                    try:
+                        update = Update.de_json(job["update"], application.bot)
+                        await process_update_once(application, update)
+                    finally:
+                        heartbeat.cancel()
+                        if BOT_LIFECYCLE != "warm":
+                            await application.shutdown()
+                    queue_logger.info(f"Processed queued update {job['update'].get('update_id')} after {time.time() - job['enqueued_at']:.2f}s")
+                await queue.ack(partition, raw)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Leave the job leased; it is redelivered after the visibility timeout
+                errors_total.inc(handler="worker")
+                queue_logger.error(f"Update worker error on partition {partition}: {str(e)}")
+                await asyncio.sleep(1)
+    finally:
+        try:
+            await queue.release_partition(partition, owner)
+        except Exception as e:
+            queue_logger.warning(f"Could not release partition {partition}: {str(e)}")
+
+# Start one worker per partition
+def start_update_workers():
+    global update_workers_running
+    update_workers_running = True
+    for partition in range(QUEUE_PARTITIONS):
+        update_worker_tasks.append(asyncio.create_task(update_worker(partition)))
+
+# Stop all update workers
+async def stop_update_workers():
+    global update_workers_running
+    update_workers_running = False
+    for task in update_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*update_worker_tasks, return_exceptions=True)
+    update_worker_tasks.clear()
+
+# Webhook endpoint
+@app.post("/webhook")
+async def telegram_webhook(request: Request):
+    with webhook_seconds.time(mode=UPDATE_QUEUE_MODE):
+        if UPDATE_QUEUE_MODE != "off":
+            try:
+                update_json = await request.json()
+                if not isinstance(update_json, dict) or "update_id" not in update_json:
+                    return Response(content="Error: invalid update", status_code=400)
+                with log_scope(update_json["update_id"], get_update_chat_id(update_json)):
+                    log_payload(logger, "Update", update_json)
+                    await enqueue_update(update_json)
+                return Response(status_code=200)
+            except Exception as e:
+                errors_total.inc(handler="webhook")
+                logger.error(f"Webhook error: {str(e)}")
+                return Response(content=f"Error: {str(e)}", status_code=500)
+        
+        application = None
+        try:
+            application = await initialize_bot()
+            update_json = await request.json()
+            update = Update.de_json(update_json, application.bot)
+
+            # Process updates synchronously
+            with log_scope(update.update_id, update.effective_chat.id if update.effective_chat else None):
+                logger.info(f"Received update {update.update_id}")
+                log_payload(logger, "Update", update_json)
+                await process_update_once(application, update)
+                logger.info("Update processed successfully")
+            return Response(status_code=200)
+        except Exception as e:
+            errors_total.inc(handler="webhook")
+            logger.error(f"Webhook error: {str(e)}")
+            return Response(content=f"Error: {str(e)}", status_code=500)
+        finally:
+            if application is not None and BOT_LIFECYCLE != "warm":
+                await application.shutdown()
+
+# Metrics endpoint in the Prometheus text format
+@app.get("/metrics")
+async def metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response(content="Unauthorized", status_code=401)
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
 
 # Startup event
 @app.on_event("startup")
 async def startup():
     logger.info("Application startup")
+    start_loop_monitor()
+    if BOT_LIFECYCLE == "warm" and TOKEN:
+        try:
+            await initialize_bot()
+        except Exception as e:
+            logger.error(f"Failed to warm up Telegram application: {str(e)}")
+    if UPDATE_QUEUE_MODE != "off" and QUEUE_RUN_WORKERS:
+        start_update_workers()
 
 # Shutdown event
 @app.on_event("shutdown")
 async def shutdown():
-    logger.info("Application shutdown")
\ No newline at end of file
+    logger.info("Application shutdown")
+    await stop_loop_monitor()
+    await stop_update_workers()
+    await shutdown_bot()
+    await close_store()
+    await close_redis()
+    await close_http_session()
+    await close_openai_client()
+
+# Long-polling entry point: fetch updates with getUpdates and dispatch them to a bounded worker pool.
+# Updates of one chat run in order; the offset only moves past an update once it has been processed.
+async def run_polling():
+    start_loop_monitor()
+    application = await initialize_bot()
+    await application.bot.delete_webhook()
+    queue_logger.info(f"Long polling started (concurrency {POLL_CONCURRENCY})")
+    
+    semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+    pending = {}
+    chat_tails = {}
+    retry_ids = set()
+    # Finished updates Telegram still returns because an older one is unfinished
+    finished_ids = set()
+    attempts = {}
+    next_offset = None
+    
+    async def handle(update: Update, previous):
+        # Wait for the previous update of the same chat, whatever its outcome
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with semaphore:
+            await process_update_once(application, update)
+    
+    def dispatch(update: Update):
+        chat_key = update.effective_chat.id if update.effective_chat else None
+        previous = chat_tails.get(chat_key) if chat_key is not None else None
+        task = asyncio.create_task(handle(update, previous))
+        pending[update.update_id] = task
+        if chat_key is not None:
+            chat_tails[chat_key] = task
+            task.add_done_callback(lambda t: chat_tails.pop(chat_key, None) if chat_tails.get(chat_key) is t else None)
+    
+    def collect_finished():
+        for update_id, task in list(pending.items()):
+            if not task.done():
+                continue
+            del pending[update_id]
+            error = task.exception()
+            if error is None:
+                attempts.pop(update_id, None)
+                finished_ids.add(update_id)
+                continue
+            attempts[update_id] = attempts.get(update_id, 0) + 1
+            if attempts[update_id] < POLL_MAX_ATTEMPTS:
+                queue_logger.error(f"Update {update_id} failed, will retry: {str(error)}")
+                retry_ids.add(update_id)
+            else:
+                queue_logger.error(f"Giving up on update {update_id} after {POLL_MAX_ATTEMPTS} attempts: {str(error)}")
+                attempts.pop(update_id, None)
+                finished_ids.add(update_id)
+    
+    try:
+        while True:
+            # Apply back-pressure instead of fetching more than the pool can absorb
+            while len(pending) >= POLL_CONCURRENCY * 4:
+                await asyncio.wait(list(pending.values()), return_when=asyncio.FIRST_COMPLETED)
+            collect_finished()
+            
+            unconfirmed = set(pending) | retry_ids
+            offset = min(unconfirmed) if unconfirmed else next_offset
+            finished_ids.difference_update([update_id for update_id in finished_ids if offset is None or update_id < offset])
+            try:
+                updates = await application.bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+            except RetryAfter as e:
+                await asyncio.sleep(get_retry_after_seconds(e))
+                continue
+            except Exception as e:
+                queue_logger.error(f"getUpdates failed: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            
+            dispatched = False
+            for update in updates:
+                next_offset = max(next_offset or 0, update.update_id + 1)
+                if update.update_id in pending or update.update_id in finished_ids:
+                    continue
+                retry_ids.discard(update.update_id)
+                dispatch(update)
+                dispatched = True
+            # The offset stays at the oldest unfinished update, so Telegram answers at once with updates that are
+            # running or done; wait for one to finish (or for newer updates to arrive) instead of polling in a tight loop
+            if updates and not dispatched:
+                await asyncio.wait(list(pending.values()), return_when=asyncio.FIRST_COMPLETED, timeout=POLL_BUSY_INTERVAL)
+    finally:
+        if pending:
+            await asyncio.wait(list(pending.values()))
+            collect_finished()
+        if next_offset is not None and not retry_ids:
+            # Confirm the last processed updates so they are not redelivered on restart
+            try:
+                await application.bot.get_updates(offset=next_offset, timeout=0)
+            except Exception as e:
+                queue_logger.warning(f"Could not confirm final offset: {str(e)}")
+        await shutdown_bot()
+        await close_store()
+        await close_redis()
+        await close_http_session()
+        await close_openai_client()
+        await stop_loop_monitor()
+        queue_logger.info("Long polling stopped")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_polling())
+    except KeyboardInterrupt:
+        pass
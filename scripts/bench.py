@@ -0,0 +1,368 @@
+"""Offline load test of the webhook with local stand-ins for every external service.
+
+Usage:
+    python scripts/bench.py [--count 500] [--rate 50] [--mix message=70,ask=20,draw=5,generate=5]
+    python scripts/bench.py --updates updates.jsonl --rate 0
+    python scripts/bench.py --write-updates updates.jsonl --count 1000
+
+Starts a local HTTP server that plays the Telegram Bot API (including file
+downloads) and the OpenAI images API, replaces the Grok chat, streaming and
+image calls with in-process fakes of configurable latency, and uses
+fakeredis (with lupa for the image slot script) unless --redis points at a
+real server. --storage picks the backend for history, caches and dedupe keys
+(a throwaway SQLite file for "sqlite"). The xAI SDK talks gRPC, so Grok is
+faked in process rather than over the network.
+
+Updates are read from a JSONL file (one Telegram update per line) or
+synthesized from --mix, then POSTed to /webhook at --rate updates per second
+(0 sends them as fast as --concurrency allows). The report shows updates/sec,
+p50/p95/p99 webhook latency per handler, error replies, peak RSS and event
+loop lag. Environment variables of the bot (STREAM_REPLIES,
+TELEGRAM_RATE_LIMIT, HISTORY_SUMMARY, ...) are honored; see README.md.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = "123456:bench"
+# 1x1 transparent PNG served for every image
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+SAMPLE_TEXTS = [
+    "hello there",
+    "what is the capital of France?",
+    "can you explain how a hash map works",
+    "latest news about the weather today",
+    "write a short poem about the sea",
+]
+SAMPLE_PROMPTS = ["a cat in a tree", "a cute baby sea otter", "a lighthouse at dawn", "a watercolor city"]
+
+
+# Bot API and OpenAI images API stand-in, recording what the bot sent
+class FakeServices:
+    def __init__(self, telegram_latency: float, openai_latency: float):
+        from aiohttp import web
+
+        self.telegram_latency = telegram_latency
+        self.openai_latency = openai_latency
+        self.message_id = 0
+        self.calls = {}
+        self.error_replies = 0
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self.bot_api)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.serve_image)
+        self.app.router.add_get("/images/{name}", self.serve_image)
+        self.app.router.add_post("/v1/images/generations", self.openai_images)
+        self.app.router.add_post("/v1/images/edits", self.openai_images)
+
+    def message(self, chat_id, **fields):
+        self.message_id += 1
+        chat_id = int(chat_id or 0)
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        return {"message_id": self.message_id, "date": int(time.time()), "chat": chat, **fields}
+
+    async def bot_api(self, request):
+        from aiohttp import web
+
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await request.post()
+        await asyncio.sleep(self.telegram_latency)
+        chat_id = data.get("chat_id")
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "BahlulBot"}
+        elif method in ("sendMessage", "editMessageText"):
+            text = data.get("text", "")
+            if text.startswith(("Error", "Sorry")):
+                self.error_replies += 1
+            result = self.message(chat_id, text=text)
+        elif method == "sendPhoto":
+            photo = {"file_id": f"photo-{self.message_id}", "file_unique_id": f"u{self.message_id}", "width": 1, "height": 1}
+            result = self.message(chat_id, photo=[photo])
+        elif method == "getFile":
+            result = {"file_id": data.get("file_id"), "file_unique_id": "u", "file_size": len(PNG_BYTES), "file_path": "photos/bench.png"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def serve_image(self, request):
+        from aiohttp import web
+
+        return web.Response(body=PNG_BYTES, content_type="image/png")
+
+    async def openai_images(self, request):
+        from aiohttp import web
+
+        self.calls["openai.images"] = self.calls.get("openai.images", 0) + 1
+        await request.read()
+        await asyncio.sleep(self.openai_latency)
+        return web.json_response({"created": int(time.time()), "data": [{"b64_json": base64.b64encode(PNG_BYTES).decode()}]})
+
+
+# Build a Telegram update for a command or a plain message
+def make_update(update_id: int, chat_id: int, kind: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+    }
+    if kind == "message":
+        message["text"] = random.choice(SAMPLE_TEXTS)
+    elif kind in ("edit", "goodedit"):
+        message["caption"] = f"/{kind} {random.choice(SAMPLE_PROMPTS)}"
+        message["photo"] = [{"file_id": f"in-{update_id}", "file_unique_id": f"in{update_id}", "width": 1, "height": 1, "file_size": len(PNG_BYTES)}]
+    else:
+        argument = random.choice(SAMPLE_TEXTS if kind == "ask" else SAMPLE_PROMPTS)
+        message["text"] = f"/{kind} {argument}"
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(kind) + 1}]
+    return {"update_id": update_id, "message": message}
+
+
+# Synthesize updates spread over chats, with handlers drawn from the weighted mix
+def synthesize_updates(count: int, chats: int, mix: dict) -> list:
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    return [
+        make_update(100000 + index, 1000 + index % chats, random.choices(kinds, weights)[0])
+        for index in range(count)
+    ]
+
+
+# Name of the handler an update is routed to, for the per-handler report
+def get_handler_name(update: dict) -> str:
+    message = update.get("message") or {}
+    text = message.get("text") or message.get("caption") or ""
+    if text.startswith("/"):
+        return text[1:].split()[0].split("@")[0].lower() if len(text) > 1 else "message"
+    return "message"
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        name, weight = item.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# Measure how late the event loop wakes up from short sleeps
+async def monitor_loop_lag(lags: list, interval: float, stop: asyncio.Event):
+    while not stop.is_set():
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(time.perf_counter() - started_at - interval, 0.0))
+
+
+# Point the bot at the stand-ins and import it (its configuration is read at import time)
+def import_bot(base_url: str, updates: list, args):
+    ids = set()
+    for update in updates:
+        message = update.get("message") or {}
+        for key in ("chat", "from"):
+            if isinstance(message.get(key), dict):
+                ids.add(str(message[key]["id"]))
+    os.environ.setdefault("TELEGRAM_TOKEN", BENCH_TOKEN)
+    os.environ["TELEGRAM_API_BASE_URL"] = base_url
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("GROK_API_KEY", "bench")
+    os.environ.setdefault("WHITELIST_IDS", ",".join(sorted(ids)))
+    os.environ.setdefault("TELEGRAM_RATE_LIMIT", "false")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("UPDATE_QUEUE_MODE", "off")
+    os.environ.setdefault("STORAGE_BACKEND", args.storage)
+    if args.storage == "sqlite":
+        os.environ.setdefault("STORAGE_SQLITE_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db"))
+    if args.redis != "fake":
+        os.environ.setdefault("REDIS_URL", args.redis)
+    sys.path.insert(0, REPO_ROOT)
+    import api.app as bot
+    return bot
+
+
+# Replace the Grok calls with in-process fakes and Redis with fakeredis
+def install_fakes(bot, args):
+    async def fake_grok_chat(conversation: list, search_mode: str = "auto") -> str:
+        await asyncio.sleep(args.llm_latency)
+        return f"Echo: {conversation[-1]['content']}"
+
+    async def fake_grok_chat_stream(conversation: list, search_mode: str = "auto"):
+        text = ""
+        for word in f"Echo: {conversation[-1]['content']}".split():
+            await asyncio.sleep(args.llm_latency / 8)
+            text = f"{text} {word}".strip()
+            yield text
+
+    class FakeImage:
+        def __init__(self, prompt: str):
+            self.url = f"{os.environ['TELEGRAM_API_BASE_URL']}/images/{abs(hash(prompt))}.png"
+            self.prompt = prompt
+
+    async def fake_grok_image(prompt: str):
+        await asyncio.sleep(args.image_latency)
+        return FakeImage(prompt)
+
+    bot.LLM_PROVIDER_FUNCTIONS["grok"] = fake_grok_chat
+    bot.grok_chat_stream = fake_grok_chat_stream
+    bot.grok_image = fake_grok_image
+
+    if args.redis == "fake":
+        import fakeredis.aioredis
+
+        fake_redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+
+        async def fake_init_redis():
+            return fake_redis
+
+        bot.init_redis = fake_init_redis
+
+
+async def run(args, updates: list) -> dict:
+    import httpx
+    from aiohttp import web
+
+    services = FakeServices(args.telegram_latency, args.image_latency)
+    runner = web.AppRunner(services.app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    bot = import_bot(f"http://127.0.0.1:{port}", updates, args)
+    install_fakes(bot, args)
+    await bot.startup()
+
+    latencies = {}
+    failures = {}
+    lags = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(lags, 0.01, stop))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=bot.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def send(update: dict):
+            handler = get_handler_name(update)
+            async with semaphore:
+                started_at = time.perf_counter()
+                response = await client.post("/webhook", json=update)
+                latencies.setdefault(handler, []).append(time.perf_counter() - started_at)
+                if response.status_code != 200:
+                    failures[handler] = failures.get(handler, 0) + 1
+
+        started_at = time.perf_counter()
+        tasks = []
+        for index, update in enumerate(updates):
+            if args.rate > 0:
+                delay = started_at + index / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(update)))
+        await asyncio.gather(*tasks)
+        if bot.UPDATE_QUEUE_MODE == "local":
+            # Queued updates are acknowledged at once, so the latencies above only cover enqueueing;
+            # include the time the workers take to drain the queue in the throughput
+            queue = bot.get_update_queue()
+            while any(not partition.empty() for partition in queue.queues) or any(queue.leases):
+                await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started_at
+
+    stop.set()
+    await lag_task
+    await bot.shutdown()
+    await runner.cleanup()
+
+    return {
+        "updates": len(updates),
+        "elapsed": elapsed,
+        "updates_per_second": len(updates) / elapsed if elapsed else 0.0,
+        "handlers": {
+            handler: {
+                "count": len(values),
+                "failures": failures.get(handler, 0),
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+            }
+            for handler, values in sorted(latencies.items())
+        },
+        "error_replies": services.error_replies,
+        "bot_api_calls": services.calls,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "loop_lag": {"p50": percentile(lags, 0.50), "p99": percentile(lags, 0.99), "max": max(lags, default=0.0)},
+    }
+
+
+# Print the benchmark results
+def report(results: dict):
+    print(f"{results['updates']} updates in {results['elapsed']:.2f} s: {results['updates_per_second']:.1f} updates/sec")
+    print(f"  {'handler':<12} {'count':>6} {'fail':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for handler, stats in results["handlers"].items():
+        print(f"  {handler:<12} {stats['count']:>6} {stats['failures']:>5} "
+              f"{stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+    print(f"Error replies sent to users: {results['error_replies']}")
+    print(f"Bot API calls: {', '.join(f'{method}={count}' for method, count in sorted(results['bot_api_calls'].items()))}")
+    print(f"Peak RSS: {results['peak_rss_mb']:.1f} MB")
+    lag = results["loop_lag"]
+    print(f"Event loop lag: p50 {lag['p50'] * 1000:.1f} ms, p99 {lag['p99'] * 1000:.1f} ms, max {lag['max'] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", help="JSONL file with one Telegram update per line")
+    parser.add_argument("--write-updates", help="write the synthesized updates to this JSONL file and exit")
+    parser.add_argument("--count", type=int, default=500, help="number of updates to synthesize")
+    parser.add_argument("--chats", type=int, default=50, help="number of chats the synthesized updates are spread over")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("message=70,ask=20,draw=5,generate=5"),
+                        help="weighted handler mix, e.g. message=70,ask=20,draw=5,generate=5,edit=1")
+    parser.add_argument("--rate", type=float, default=50, help="updates per second (0 sends as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=64, help="maximum webhook requests in flight")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake Grok chat call")
+    parser.add_argument("--image-latency", type=float, default=0.5, help="seconds per fake Grok or OpenAI image call")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="seconds per fake Bot API call")
+    parser.add_argument("--redis", default="fake", help='"fake" for fakeredis, or a Redis URL')
+    parser.add_argument("--storage", default="redis", choices=["redis", "memory", "sqlite"],
+                        help="storage backend for history, caches and dedupe keys")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for synthesized updates")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.updates:
+        with open(args.updates) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = synthesize_updates(args.count, args.chats, args.mix)
+    if args.write_updates:
+        with open(args.write_updates, "w") as f:
+            for update in updates:
+                f.write(json.dumps(update) + "\n")
+        print(f"Wrote {len(updates)} updates to {args.write_updates}")
+        return
+
+    results = asyncio.run(run(args, updates))
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Micro-benchmark of the stored history entry encodings.
+
+Usage:
+    python scripts/history_codec_bench.py [--conversations 200] [--messages 50] [--rounds 5]
+
+Synthesizes conversations shaped like the bot's history (short questions,
+long markdown Grok answers, /draw and /generate turns with image URLs and
+revised prompts, some non-ASCII chats) and compares the legacy JSON entries
+with the compact encoding at several compression thresholds: stored bytes,
+and encode/decode time per message. Prints whether orjson was used.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORDS = (
+    "the a of to and in is that for it with as on was be by this are or from at an have which one you "
+    "model token latency cache request history telegram image prompt answer question python redis server "
+    "because however example result value error function number between different important"
+).split()
+NON_ASCII_WORDS = ["mahal", "harga", "berapa", "ãé", "日本語", "привет", "café", "naïve", "😀"]
+
+
+# One random sentence
+def sentence(rng: random.Random, words: list) -> str:
+    text = " ".join(rng.choice(words) for _ in range(rng.randint(6, 18)))
+    return text[0].upper() + text[1:] + "."
+
+
+# Build one conversation of user and assistant turns
+def make_conversation(rng: random.Random, messages: int) -> list:
+    words = WORDS + NON_ASCII_WORDS if rng.random() < 0.2 else WORDS
+    conversation = []
+    while len(conversation) < messages:
+        kind = rng.random()
+        if kind < 0.1:
+            prompt = " ".join(rng.choice(words) for _ in range(rng.randint(4, 12)))
+            conversation.append({"role": "user", "content": f"/draw {prompt}"})
+            conversation.append({"role": "assistant", "content": f"Generated image with prompt: {prompt}"})
+        elif kind < 0.2:
+            prompt = " ".join(rng.choice(words) for _ in range(rng.randint(4, 12)))
+            url = f"https://imgen.x.ai/xai-imgen/xai-tmp-imgen-{rng.getrandbits(128):032x}.jpeg"
+            conversation.append({"role": "user", "content": f"/generate {prompt}"})
+            conversation.append({"role": "assistant", "content": f"Generated image: {url} (Revised prompt: {sentence(rng, words)} {sentence(rng, words)})"})
+        else:
+            conversation.append({"role": "user", "content": " ".join(sentence(rng, words) for _ in range(rng.randint(1, 3)))})
+            paragraphs = []
+            for _ in range(rng.randint(1, 6)):
+                if rng.random() < 0.3:
+                    paragraphs.append("\n".join(f"- **{rng.choice(words)}**: {sentence(rng, words)}" for _ in range(rng.randint(2, 6))))
+                else:
+                    paragraphs.append(" ".join(sentence(rng, words) for _ in range(rng.randint(2, 8))))
+            conversation.append({"role": "assistant", "content": "\n\n".join(paragraphs)})
+    return conversation[:messages]
+
+
+# Encode and decode every message, returning (bytes, encode us/msg, decode us/msg)
+def measure(bot, messages: list, rounds: int) -> tuple:
+    best_encode = best_decode = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        entries = [bot.encode_history_entry(message) for message in messages]
+        best_encode = min(best_encode, time.perf_counter() - start)
+        start = time.perf_counter()
+        decoded = [bot.decode_history_entry(entry) for entry in entries]
+        best_decode = min(best_decode, time.perf_counter() - start)
+    assert [message["content"] for message in decoded] == [message["content"] for message in messages]
+    size = sum(len(entry.encode()) for entry in entries)
+    return size, best_encode / len(messages) * 1e6, best_decode / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=200, help="number of conversations")
+    parser.add_argument("--messages", type=int, default=50, help="messages per conversation")
+    parser.add_argument("--rounds", type=int, default=5, help="timing rounds; the fastest is reported")
+    parser.add_argument("--thresholds", default="256,512,1024,4096", help="compression thresholds in bytes to compare")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, REPO_ROOT)
+    import api.app as bot
+
+    rng = random.Random(args.seed)
+    messages = [message for _ in range(args.conversations) for message in make_conversation(rng, args.messages)]
+    print(f"{len(messages)} messages, orjson {'installed' if bot.get_orjson() else 'not installed (json fallback)'}")
+
+    settings = [("legacy json", "json", 0)]
+    settings += [(f"compact, zlib >= {threshold} B", "compact", int(threshold)) for threshold in args.thresholds.split(",")]
+    settings.append(("compact, no zlib", "compact", sys.maxsize))
+    baseline = None
+    print(f"  {'encoding':<26} {'bytes':>12} {'saved':>7} {'encode us':>10} {'decode us':>10}")
+    for title, encoding, threshold in settings:
+        bot.HISTORY_ENCODING = encoding
+        bot.HISTORY_COMPRESS_MIN_BYTES = threshold
+        size, encode_us, decode_us = measure(bot, messages, args.rounds)
+        baseline = baseline or size
+        print(f"  {title:<26} {size:>12,} {1 - size / baseline:>6.1%} {encode_us:>10.2f} {decode_us:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Import-time profile of the bot (like `python -X importtime`, summarized).
+
+Usage:
+    python scripts/import_profile.py [--top 20] [--with-providers]
+
+Runs a fresh interpreter that imports api.app with -X importtime and prints
+the total import time and the slowest top-level imports. --with-providers
+also imports the lazily loaded provider stacks (xai_sdk, openai, aiohttp)
+to show what a text-only cold start no longer pays for.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROVIDER_MODULES = ["xai_sdk", "openai", "aiohttp"]
+
+
+# Run an interpreter importing the given modules and return parsed -X importtime rows
+def profile_imports(modules: list) -> list:
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        name = name.rstrip()
+        rows.append({
+            "self": int(self_us),
+            "cumulative": int(cumulative_us),
+            "name": name.strip(),
+            # Nested imports are indented by two spaces per level
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+        })
+    return rows
+
+
+# Print the total and the slowest top-level and direct imports
+def report(title: str, rows: list, top: int):
+    total_ms = sum(row["cumulative"] for row in rows if row["depth"] == 0) / 1000
+    print(f"{title}: {total_ms:.1f} ms total, {len(rows)} modules")
+    shallow = [row for row in rows if row["depth"] <= 1]
+    for row in sorted(shallow, key=lambda row: row["cumulative"], reverse=True)[:top]:
+        indent = "  " * row["depth"]
+        print(f"  {row['cumulative'] / 1000:8.1f} ms  {indent}{row['name']}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=20, help="number of slowest imports to show")
+    parser.add_argument("--with-providers", action="store_true", help="also profile with the provider stacks loaded")
+    args = parser.parse_args()
+
+    report("api.app (cold start)", profile_imports(["api.app"]), args.top)
+    if args.with_providers:
+        report("api.app + providers", profile_imports(["api.app"] + PROVIDER_MODULES), args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from api.app import TELEGRAM_MAX_MESSAGE_LENGTH, split_message
+
+
+def test_short_text_is_one_message():
+    assert split_message("hello") == ["hello"]
+
+
+def test_long_code_block_reopens_fence_in_each_part():
+    text = "```python\n" + "\n".join(f"print({i})" for i in range(1000)) + "\n```"
+    chunks = split_message(text)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(chunk) <= TELEGRAM_MAX_MESSAGE_LENGTH
+        assert chunk.startswith("```python\n") and chunk.endswith("\n```")
+
+
+def test_content_on_long_fence_line_terminates():
+    text = "Here:\n\n```" + '{"k": "' + "v" * 5000 + '"}```'
+    chunks = split_message(text)
+    assert all(len(chunk) <= TELEGRAM_MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert "".join(chunks).count("v") == 5000
+
+
+def test_unclosed_single_line_fence_is_not_dropped():
+    chunks = split_message("```" + "y" * 5000)
+    assert chunks
+    assert all(len(chunk) <= TELEGRAM_MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert "".join(chunks).count("y") == 5000
+
+
+def test_fence_line_content_is_not_copied_into_every_part():
+    text = "```" + "x" * 3000 + "\n" + "\n".join("line" * 20 for _ in range(100)) + "\n```"
+    chunks = split_message(text)
+    assert sum(len(chunk) for chunk in chunks) < len(text) + 100
+    assert "".join(chunks).count("x") == 3000
+
+
+def test_fence_that_leaves_no_room_is_plain_text():
+    chunks = split_message("```python\n" + "z" * 50, limit=20)
+    assert chunks
+    assert all(0 < len(chunk) <= 20 for chunk in chunks)